@@ -0,0 +1,75 @@
+"""Measures the import time that cold starts pay for each cloud function and the cloud run service.
+
+Every measurement runs in a fresh interpreter so nothing is cached between runs.
+
+usage: python benchmarks/import_time.py [--repeat 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports done on a cold start: the entrypoint module, then the connector
+# module the first call of a handler imports
+TARGETS = {
+    'amazon-sp': (ROOT, ['main', 'popl.amazon.amazon_sp']),
+    'rakuten-smartfill': (ROOT, ['main', 'popl.rakuten.rakuten']),
+    '3pl-central': (ROOT, ['main', 'popl.tpl.tpl']),
+    'firebase-extractor': (os.path.join(ROOT, 'firebase'), ['main']),
+}
+
+# The firebase service reads these at import time
+SERVICE_ENV = {
+    'BUCKET_NAME': 'benchmark',
+    'DEFAULT_BATCH_SIZE': '1000',
+    'MAX_RUN_TIME': '3300',
+}
+
+SCRIPT = """
+import json, sys, time
+timings = {}
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    module_start = time.perf_counter()
+    __import__(module)
+    timings[module] = time.perf_counter() - module_start
+timings['total'] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def measure(cwd: str, modules: list) -> dict:
+    env = dict(os.environ, **SERVICE_ENV)
+    # The firebase service also imports the shared popl modules from the repo root
+    env['PYTHONPATH'] = os.pathsep.join([cwd, ROOT])
+    result = subprocess.run([sys.executable, '-c', SCRIPT] + modules, cwd=cwd, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters per target')
+    args = arg_parser.parse_args()
+
+    print(f"{'target':<20} {'module':<26} {'median ms':>10} {'max ms':>10}")
+    for target, (cwd, modules) in TARGETS.items():
+        try:
+            runs = [measure(cwd, modules) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{target:<20} failed: {e}")
+            continue
+
+        for module in modules + ['total']:
+            timings = [run[module] * 1000 for run in runs]
+            print(f"{target:<20} {module:<26} {statistics.median(timings):>10.1f} {max(timings):>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
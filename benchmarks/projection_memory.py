@@ -0,0 +1,87 @@
+"""Peak memory of decoding and holding connector records, with and without field projection.
+
+Pages of synthetic Rakuten items and 3PL inventory, shaped like the stub
+servers' responses, are decoded and every record is held, as the connectors
+did before records were pruned and compacted. The peak traced by
+tracemalloc is reported per 100k items.
+
+usage:
+    python benchmarks/projection_memory.py --items 100000
+    python benchmarks/projection_memory.py --rakuten-fields stockKeepingUnit,quantity --tpl-fields AvailableQty
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import rakuten_item, tpl_inventory_item  # noqa: E402
+from popl.projection import Projection, parse_fields  # noqa: E402
+
+STREAMS = {
+    'rakuten/items': (rakuten_item, 'data', ["stockKeepingUnit"]),
+    'tpl/inventory': (tpl_inventory_item, 'ResourceList', ["ReceiveItemId"]),
+}
+
+
+def _pages(factory, records_key: str, items: int, page_size: int, record_size: int):
+    pages = []
+    for start in range(0, items, page_size):
+        records = [factory(idx, record_size, random.Random(idx)) for idx in range(start, min(start + page_size, items))]
+        pages.append(json.dumps({records_key: records, '_links': {'next': {'href': '/next'}}}).encode('utf-8'))
+    return pages
+
+
+def _peak(pages, decode) -> int:
+    gc.collect()
+    tracemalloc.start()
+    held = []
+    for page in pages:
+        held.extend(decode(page))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def measure(stream: str, fields, items: int, page_size: int, record_size: int) -> dict:
+    factory, records_key, primary_key = STREAMS[stream]
+    pages = _pages(factory, records_key, items, page_size, record_size)
+    projection = Projection(fields, primary_key)
+
+    before = _peak(pages, lambda page: json.loads(page)[records_key])
+    after = _peak(pages, lambda page: projection.compact_all(projection.loads(page)[records_key]))
+    per_100k = 100_000 / items
+    return {
+        'stream': stream,
+        'fields': ','.join(fields) if fields else '(all but _links)',
+        'before_mib': round(before * per_100k / 2 ** 20, 1),
+        'after_mib': round(after * per_100k / 2 ** 20, 1),
+        'saved': f"{1 - after / before:.0%}",
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                         formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    arg_parser.add_argument('--items', type=int, default=100000)
+    arg_parser.add_argument('--page-size', type=int, default=1000)
+    arg_parser.add_argument('--record-size', type=int, default=200, help='bytes of padding per record')
+    arg_parser.add_argument('--rakuten-fields', help='fields kept for rakuten items, all by default')
+    arg_parser.add_argument('--tpl-fields', help='fields kept for tpl inventory, all by default')
+    args = arg_parser.parse_args()
+
+    fields = {'rakuten/items': parse_fields(args.rakuten_fields), 'tpl/inventory': parse_fields(args.tpl_fields)}
+    print(f"{'stream':<16} {'fields':<40} {'before MiB/100k':>16} {'after MiB/100k':>16} {'saved':>6}")
+    for stream in STREAMS:
+        result = measure(stream, fields[stream], args.items, args.page_size, args.record_size)
+        print(f"{result['stream']:<16} {result['fields']:<40} {result['before_mib']:>16} "
+              f"{result['after_mib']:>16} {result['saved']:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Offline benchmarks for the connectors and the firebase exporter.
+
+Connectors run against the local stub servers in stubs.py. The firebase
+exporter runs against the Firestore emulator and a fake GCS server, which
+must be running and pointed at with FIRESTORE_EMULATOR_HOST and
+STORAGE_EMULATOR_HOST. Each benchmark reports throughput, peak RSS and the
+number of API calls made.
+
+usage:
+    python benchmarks/run.py rakuten --records 100000 --latency 0.05
+    python benchmarks/run.py amazon --records 2000 --throttle-every 50
+    python benchmarks/run.py firebase --populate 10000
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import StubServer  # noqa: E402
+
+
+class Request:
+    """Minimal stand in for the flask request passed to the handlers"""
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.args = {}
+
+    def get_json(self):
+        return self.data
+
+
+def _peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _consume(body) -> int:
+    """Reads a handler response body, which may be a string or streamed chunks, and returns its size"""
+    if hasattr(body, 'response'):
+        body = body.response
+    if isinstance(body, (str, bytes)):
+        return len(body)
+    return sum(len(chunk) for chunk in body)
+
+
+def _install_amazon_stubs(amazon_sp, url: str):
+    """Replaces the sp_api clients with clients that call the stub server
+
+    sp_api signs requests with AWS and LWA credentials, so the benchmark swaps
+    the client classes rather than the endpoint.
+    """
+    import requests
+    from sp_api.base.exceptions import SellingApiRequestThrottledException
+
+    session = requests.Session()
+
+    class StubResponse:
+        def __init__(self, body):
+            self.payload = body.get('payload')
+            self.pagination = body.get('pagination')
+
+    def get(path, params):
+        response = session.get(f"{url}{path}", params=params)
+        if response.status_code == 429:
+            raise SellingApiRequestThrottledException(response.json()['errors'])
+        return StubResponse(response.json())
+
+    class Inventories:
+        def get_inventory_summary_marketplace(self, details=True, nextToken=None, **kwargs):
+            return get('/fba/inventory/v1/summaries', {'details': details, 'nextToken': nextToken})
+
+    class Sales:
+        def get_order_metrics(self, interval, granularity, **kwargs):
+            params = dict(kwargs, interval='--'.join(interval), granularity=granularity.value)
+            return get('/sales/v1/orderMetrics', params)
+
+    amazon_sp.Inventories = Inventories
+    amazon_sp.Sales = Sales
+
+
+def run_connector(args) -> dict:
+    stub = StubServer(args.target, total_records=args.records, page_size=args.page_size, latency=args.latency,
+                      throttle_every=args.throttle_every, record_size=args.record_size).start()
+    try:
+        if args.target == 'amazon':
+            os.environ.setdefault('SALES_REQUEST_INTERVAL', '0')
+            from popl.amazon import amazon_sp
+            _install_amazon_stubs(amazon_sp, stub.url)
+            handler = amazon_sp.amazon_sp_handler
+        elif args.target == 'rakuten':
+            from popl.rakuten import rakuten
+            from popl.rakuten.client import RakutenClient
+            RakutenClient.base_url = stub.url
+            handler = rakuten.rakuten_handler
+        else:
+            from popl.tpl import tpl
+            from popl.tpl.client import TPLClient
+            TPLClient._base_url = stub.url
+            handler = tpl.tpl_handler
+
+        from popl import metrics
+
+        start = time.perf_counter()
+        response = handler(Request({'state': {}}))
+        status = response.status_code
+        response_bytes = _consume(response)
+        elapsed = time.perf_counter() - start
+    finally:
+        stub.stop()
+
+    summary = metrics.last_runs()
+    run_metrics = next(iter(summary.values()), {})
+    records = sum(value for name, value in run_metrics.get('counters', {}).items() if name.endswith('_records'))
+    return {
+        'target': args.target,
+        'status': status,
+        'elapsed_seconds': round(elapsed, 3),
+        'records': records,
+        'records_per_second': round(records / elapsed, 1) if elapsed else 0,
+        'response_bytes': response_bytes,
+        'response_bytes_per_second': round(response_bytes / elapsed, 1) if elapsed else 0,
+        'peak_rss_mib': round(_peak_rss_mib(), 1),
+        'api_calls': dict(stub.calls),
+        'throttled_calls': dict(stub.throttled),
+        'metrics': run_metrics,
+    }
+
+
+def run_firebase(args) -> dict:
+    for name in ('FIRESTORE_EMULATOR_HOST', 'STORAGE_EMULATOR_HOST'):
+        if not os.getenv(name):
+            raise SystemExit(f"{name} must point at a running emulator")
+
+    workdir = tempfile.mkdtemp(prefix='firebase-benchmark-')
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'benchmark')
+    os.environ.setdefault('BUCKET_NAME', 'benchmark')
+    os.environ.setdefault('DEFAULT_BATCH_SIZE', '1000')
+    os.environ.setdefault('MAX_RUN_TIME', '3300')
+    os.environ.setdefault('OFFSET_BACKEND', 'sqlite')
+    os.environ.setdefault('OFFSET_SQLITE_PATH', os.path.join(workdir, 'offsets.db'))
+    os.environ.setdefault('DEFAULT_OFFSET_KEY', 'updatedAt')
+
+    if args.populate:
+        from benchmarks.synthetic import firestore_client, populate
+        populate(firestore_client(os.environ['GOOGLE_CLOUD_PROJECT']), 'people', args.populate, args.record_size)
+
+    sys.path.insert(0, os.path.join(ROOT, 'firebase'))
+    import firebase
+    from popl import metrics
+
+    bucket = firebase.get_storage_client().bucket(os.environ['BUCKET_NAME'])
+    if not bucket.exists():
+        bucket.create()
+
+    # Batch files are written to the working directory before being uploaded
+    os.chdir(workdir)
+    start = time.perf_counter()
+    firebase.load_firebase_collections()
+    elapsed = time.perf_counter() - start
+
+    run_metrics = metrics.last_runs()['load_firebase_collections']
+    counters = run_metrics['counters']
+    return {
+        'target': 'firebase',
+        'elapsed_seconds': round(elapsed, 3),
+        'documents': counters.get('documents', 0),
+        'documents_per_second': round(counters.get('documents', 0) / elapsed, 1) if elapsed else 0,
+        'uploaded_bytes': counters.get('uploaded_bytes', 0),
+        'uploaded_bytes_per_second': round(counters.get('uploaded_bytes', 0) / elapsed, 1) if elapsed else 0,
+        'peak_rss_mib': round(_peak_rss_mib(), 1),
+        'api_calls': {stage: stats['count'] for stage, stats in run_metrics['stages'].items()},
+        'metrics': run_metrics,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                         formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    arg_parser.add_argument('target', choices=['amazon', 'rakuten', 'tpl', 'firebase'])
+    arg_parser.add_argument('--records', type=int, default=10000, help='records served by the stub')
+    arg_parser.add_argument('--page-size', type=int, default=1000, help='records per page for token paginated stubs')
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='seconds each stub request takes')
+    arg_parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth request with a 429')
+    arg_parser.add_argument('--record-size', type=int, default=200, help='bytes of padding per record')
+    arg_parser.add_argument('--populate', type=int, default=0,
+                            help='firebase only: write this many synthetic people to the emulator first')
+    arg_parser.add_argument('--output', help='also write the json report to this file')
+    args = arg_parser.parse_args()
+
+    report = run_firebase(args) if args.target == 'firebase' else run_connector(args)
+    metrics_summary = report.pop('metrics')
+    for key, value in report.items():
+        print(f"{key:<28} {value}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(report, metrics=metrics_summary), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Local stub HTTP servers for the Amazon SP, Rakuten and 3PL Central APIs.
+
+Each stub serves synthetic records with a configurable number of records per
+page, latency, throttling and record size, and counts the calls it receives.
+"""
+import json
+import random
+import string
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def _padding(size: int, rng: random.Random) -> str:
+    return ''.join(rng.choices(string.ascii_letters, k=size))
+
+
+def rakuten_item(idx: int, record_size: int, rng: random.Random) -> dict:
+    return {
+        'stockKeepingUnit': f"SKU-{idx:08d}",
+        'name': f"Item {idx}",
+        'description': _padding(record_size, rng),
+        'quantity': rng.randint(0, 500),
+        'dimensions': {'height': rng.random(), 'width': rng.random(), 'length': rng.random(), 'weight': rng.random()},
+        'barcodes': [f"{rng.randint(10 ** 11, 10 ** 12 - 1)}" for _ in range(2)],
+    }
+
+
+def tpl_inventory_item(idx: int, record_size: int, rng: random.Random) -> dict:
+    return {
+        'ReceiveItemId': idx,
+        'ItemIdentifier': {'Sku': f"SKU-{idx:08d}", 'Id': idx},
+        'Qualifier': _padding(record_size, rng),
+        'ReceivedQty': rng.randint(0, 500),
+        'AvailableQty': rng.randint(0, 500),
+        'ReceivedDate': '2021-07-27T16:52:21',
+        '_links': {'self': {'href': f"/inventory/{idx}"}, 'item': {'href': f"/customers/1/items/{idx}"}},
+    }
+
+
+def amazon_inventory_summary(idx: int, record_size: int, rng: random.Random) -> dict:
+    return {
+        'asin': f"B{idx:09d}",
+        'fnSku': f"X{idx:09d}",
+        'sellerSku': f"SKU-{idx:08d}",
+        'condition': 'NewItem',
+        'productName': _padding(record_size, rng),
+        'totalQuantity': rng.randint(0, 500),
+        'inventoryDetails': {'fulfillableQuantity': rng.randint(0, 500)},
+    }
+
+
+def amazon_units(seed: int, sku: str) -> int:
+    """Units sold by a sku, most skus in the long tail don't sell"""
+    return random.Random(f"{seed}-{sku}").choice([0] * 18 + [1, 2])
+
+
+def amazon_order_metric(interval: str, units: int) -> dict:
+    return {
+        'interval': interval,
+        'unitCount': units,
+        'orderItemCount': units,
+        'orderCount': units,
+        'averageUnitPrice': {'amount': 19.99, 'currencyCode': 'USD'},
+        'totalSales': {'amount': 19.99 * units, 'currencyCode': 'USD'},
+    }
+
+
+class StubServer:
+    """Serves one of the vendor APIs on a random local port"""
+
+    def __init__(self, api: str, total_records: int = 10000, page_size: int = 1000, latency: float = 0.05,
+                 throttle_every: int = 0, record_size: int = 200, seed: int = 0):
+        self.api = api
+        self.total_records = total_records
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.record_size = record_size
+        self.seed = seed
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'StubServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _should_throttle(self, endpoint: str) -> bool:
+        """Counts a call to `endpoint` and whether it is throttled, requests are served on concurrent threads"""
+        with self._lock:
+            self.calls[endpoint] += 1
+            self._requests += 1
+            throttled = bool(self.throttle_every) and self._requests % self.throttle_every == 0
+            if throttled:
+                self.throttled[endpoint] += 1
+            return throttled
+
+    def _records(self, factory, start: int, count: int) -> list:
+        end = min(start + count, self.total_records)
+        return [factory(idx, self.record_size, random.Random(self.seed + idx)) for idx in range(start, end)]
+
+    def route(self, method: str, path: str, params: dict):
+        """Returns the status and json body of a request"""
+        page_size = self.page_size
+        if self.api == 'rakuten':
+            if method == 'POST' and path == '/Auth':
+                return 200, {'data': {'token': 'stub-token'}}
+            if method == 'GET' and path == '/Items':
+                page = int(params.get('page', 1))
+                page_size = int(params.get('pageSize', page_size))
+                return 200, {
+                    'pageMetadata': {'totalResults': self.total_records, 'page': page, 'pageSize': page_size},
+                    'data': self._records(rakuten_item, (page - 1) * page_size, page_size),
+                }
+        elif self.api == 'tpl':
+            if method == 'POST' and path == '/AuthServer/api/Token':
+                return 200, {'token_type': 'Bearer', 'access_token': 'stub-token'}
+            if method == 'GET' and path == '/inventory':
+                page = int(params.get('pgnum', 1))
+                page_size = int(params.get('pgsiz', page_size))
+                return 200, {
+                    'TotalResults': self.total_records,
+                    'ResourceList': self._records(tpl_inventory_item, (page - 1) * page_size, page_size),
+                    '_links': {'next': {'href': f"/inventory?pgnum={page + 1}&pgsiz={page_size}"}},
+                }
+        elif self.api == 'amazon':
+            if method == 'GET' and path == '/fba/inventory/v1/summaries':
+                start = int(params.get('nextToken') or 0)
+                next_start = start + page_size
+                return 200, {
+                    'payload': {'inventorySummaries': self._records(amazon_inventory_summary, start, page_size)},
+                    'pagination': {'nextToken': str(next_start)} if next_start < self.total_records else None,
+                }
+            if method == 'GET' and path == '/sales/v1/orderMetrics':
+                sku = params.get('sku')
+                if sku:
+                    units = amazon_units(self.seed, sku)
+                else:
+                    # Totals across every sku served by the inventory stub
+                    units = sum(amazon_units(self.seed, f"SKU-{idx:08d}") for idx in range(self.total_records))
+                return 200, {'payload': [amazon_order_metric(params.get('interval', ''), units)]}
+        return 404, {'errors': [{'code': 'NotFound', 'message': f"{method} {path} is not stubbed"}]}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, method: str):
+                parsed = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+
+                time.sleep(stub.latency)
+                endpoint = f"{method} {parsed.path}"
+                if stub._should_throttle(endpoint):
+                    status, body = 429, {'errors': [{'code': 'QuotaExceeded', 'message': 'You exceeded your quota'}]}
+                else:
+                    status, body = stub.route(method, parsed.path, params)
+
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
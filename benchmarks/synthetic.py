@@ -0,0 +1,92 @@
+"""Populates the Firestore emulator with synthetic `people` documents and subcollections.
+
+usage: FIRESTORE_EMULATOR_HOST=localhost:8081 python benchmarks/synthetic.py --documents 10000
+"""
+import argparse
+import os
+import random
+import string
+
+# Subcollections added to each person and how many documents they hold on average
+SUBCOLLECTIONS = {
+    'links': 3,
+    'devices': 1,
+}
+OFFSET_FIELD = 'updatedAt'
+# Firestore accepts at most 500 writes per batch
+BATCH_LIMIT = 500
+
+
+def firestore_client(project: str):
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit("FIRESTORE_EMULATOR_HOST must point at a running Firestore emulator")
+
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import firestore
+    return firestore.Client(project=project, credentials=AnonymousCredentials())
+
+
+def person(idx: int, document_size: int, rng: random.Random) -> dict:
+    return {
+        'name': f"Person {idx}",
+        'email': f"person{idx}@example.com",
+        OFFSET_FIELD: 1_600_000_000_000 + idx,
+        'tags': rng.sample(['nfc', 'qr', 'pro', 'team', 'trial'], k=rng.randint(0, 3)),
+        'bio': ''.join(rng.choices(string.ascii_letters + ' ', k=rng.randint(document_size // 2, document_size * 2))),
+        'profile': {
+            'company': f"Company {idx % 97}",
+            'title': rng.choice(['CEO', 'Engineer', 'Designer', 'Sales']),
+            'views': rng.randint(0, 10000),
+        },
+    }
+
+
+def subcollection_document(idx: int, rng: random.Random) -> dict:
+    return {
+        'position': idx,
+        'value': ''.join(rng.choices(string.ascii_lowercase, k=32)),
+        'clicks': rng.randint(0, 1000),
+    }
+
+
+def populate(db, collection_name: str, documents: int, document_size: int, seed: int = 0):
+    """Writes `documents` people and their subcollections in batches"""
+    rng = random.Random(seed)
+    batch = db.batch()
+    writes = 0
+
+    def add(reference, data):
+        nonlocal batch, writes
+        batch.set(reference, data)
+        writes += 1
+        if writes % BATCH_LIMIT == 0:
+            batch.commit()
+            batch = db.batch()
+
+    for idx in range(documents):
+        reference = db.collection(collection_name).document(f"person-{idx:08d}")
+        add(reference, person(idx, document_size, rng))
+        for subcollection_name, average in SUBCOLLECTIONS.items():
+            for sub_idx in range(rng.randint(0, average * 2)):
+                add(reference.collection(subcollection_name).document(str(sub_idx)), subcollection_document(sub_idx, rng))
+
+    batch.commit()
+    return writes
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--project', default=os.getenv('GOOGLE_CLOUD_PROJECT', 'benchmark'))
+    arg_parser.add_argument('--collection', default='people')
+    arg_parser.add_argument('--documents', type=int, default=10000)
+    arg_parser.add_argument('--document-size', type=int, default=500, help='average size of the bio field in bytes')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    db = firestore_client(args.project)
+    writes = populate(db, args.collection, args.documents, args.document_size, args.seed)
+    print(f"Wrote {writes} documents to {args.collection} and its subcollections")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import IO, TYPE_CHECKING, Dict, Iterator, List, Pattern
+
+from firebase import (BUCKET_NAME, PROFILES_PREFIX, configure_logging,
+                      get_storage_client)
+
+if TYPE_CHECKING:
+    from google.cloud.storage import Blob, Bucket
+
+logger = logging.getLogger(__name__)
+
+COMPACTED_PREFIX = "compacted"
+MANIFEST_NAME = "_manifest.json"
+COMPACTION_TARGET_BYTES = int(os.getenv("COMPACTION_TARGET_BYTES", 256 * 1024 * 1024))
+COMPACTION_DELETE_SOURCES = os.getenv("COMPACTION_DELETE_SOURCES", "false").lower() == "true"
+
+# GCS compose accepts at most 32 source objects per request
+COMPOSE_LIMIT = 32
+# Bytes read from and written to GCS at a time when rewriting json arrays, a multiple of 256 KiB
+REWRITE_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def list_collection_prefixes(bucket_name: str) -> List[str]:
+    """Lists the top level `collection_name/` prefixes in the bucket"""
+    iterator = get_storage_client().list_blobs(bucket_name, delimiter='/')
+    # Prefixes are only populated once the iterator has been consumed
+    list(iterator)
+    skipped = {f"{COMPACTED_PREFIX}/", f"{PROFILES_PREFIX}/"}
+    return sorted(prefix for prefix in iterator.prefixes if prefix not in skipped)
+
+
+def _batch_file_pattern(collection_name: str) -> Pattern:
+    """Matches the batch files written by the exporter, `<name>/collection_<name>_<seconds>_<fraction>.<ext>`
+
+    Other objects under the prefix, such as connector snapshots when they
+    share the bucket, are never compacted.
+    """
+    name = re.escape(collection_name)
+    return re.compile(rf"{name}/collection_{name}_(?P<seconds>\d+)_\d+\.(?P<format>json|ndjson)")
+
+
+def _partition_date(seconds: str) -> str:
+    """Gets the partition date of a batch file from the timestamp in its filename"""
+    return datetime.fromtimestamp(int(seconds), tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def _manifest_blob(bucket: 'Bucket', collection_name: str) -> 'Blob':
+    return bucket.blob(f"{COMPACTED_PREFIX}/{collection_name}/{MANIFEST_NAME}")
+
+
+def load_manifest(bucket: 'Bucket', collection_name: str) -> Dict[str, str]:
+    """Loads the mapping of already merged source objects to their compacted object"""
+    blob = _manifest_blob(bucket, collection_name)
+    if not blob.exists():
+        return {}
+    return json.loads(blob.download_as_bytes()).get('merged', {})
+
+
+def save_manifest(bucket: 'Bucket', collection_name: str, merged: Dict[str, str]):
+    blob = _manifest_blob(bucket, collection_name)
+    blob.upload_from_string(json.dumps({'merged': merged}), content_type='application/json')
+
+
+def _chunk_by_size(blobs: List['Blob'], target_size: int) -> List[List['Blob']]:
+    """Splits blobs into consecutive groups of roughly `target_size` bytes"""
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for blob in blobs:
+        if chunk and chunk_size + (blob.size or 0) > target_size:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(blob)
+        chunk_size += blob.size or 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _destination_name(collection_name: str, date: str, file_format: str, sources: List['Blob']) -> str:
+    """Builds a deterministic name for the compacted object of a group of sources
+
+    The name only depends on the sources so a run that is interrupted between
+    writing the object and the manifest doesn't produce a second copy.
+    """
+    digest = hashlib.sha1('\n'.join(blob.name for blob in sources).encode('utf-8')).hexdigest()[:16]
+    return f"{COMPACTED_PREFIX}/{collection_name}/dt={date}/part-{digest}.{file_format}"
+
+
+def _compose(bucket: 'Bucket', sources: List['Blob'], destination_name: str):
+    """Concatenates ndjson objects server side with GCS compose"""
+    destination = bucket.blob(destination_name)
+    destination.content_type = 'application/x-ndjson'
+    destination.compose(sources[:COMPOSE_LIMIT])
+    for start in range(COMPOSE_LIMIT, len(sources), COMPOSE_LIMIT - 1):
+        destination.compose([destination] + sources[start:start + COMPOSE_LIMIT - 1])
+
+
+def _array_elements(reader: IO[bytes], chunk_size: int = REWRITE_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yields the raw bytes between the outer brackets of a json array, one chunk at a time
+
+    The last non blank chunk is held back until the end of the stream so its
+    closing bracket can be dropped.
+    """
+    opened = False
+    pending = b''
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+        if not opened:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            if not chunk.startswith(b'['):
+                raise ValueError("Source is not a json array")
+            chunk = chunk[1:]
+            opened = True
+        # Blank chunks may trail the closing bracket, keep them with the chunk before
+        if chunk.strip():
+            if pending:
+                yield pending
+            pending = chunk
+        else:
+            pending += chunk
+
+    pending = pending.rstrip()
+    if not pending.endswith(b']'):
+        raise ValueError("Source is not a json array")
+    yield pending[:-1]
+
+
+def _rewrite(bucket: 'Bucket', sources: List['Blob'], destination_name: str):
+    """Merges json array objects into one array, streaming one source at a time
+
+    The elements are copied as raw bytes, so only a chunk of each source is
+    held in memory and nothing is written to the (in memory) local disk.
+    """
+    # Only closing the writer creates the object, on an error the writer cancels the upload so a failed
+    # rewrite leaves nothing behind
+    with bucket.blob(destination_name).open('wb', chunk_size=REWRITE_CHUNK_SIZE,
+                                            content_type='application/json') as writer:
+        writer.write(b'[')
+        has_elements = False
+        for blob in sources:
+            with blob.open('rb', chunk_size=REWRITE_CHUNK_SIZE) as reader:
+                separated = not has_elements
+                for data in _array_elements(reader):
+                    if not separated and data.strip():
+                        writer.write(b',')
+                        separated = True
+                    has_elements = has_elements or bool(data.strip())
+                    writer.write(data)
+        writer.write(b']')
+
+
+def compact_collection(bucket: 'Bucket', collection_name: str, target_size: int = COMPACTION_TARGET_BYTES) -> int:
+    """Merges the batch files of a collection into date partitioned objects
+
+    A group of files that fails to merge is logged and skipped, it is retried
+    by the next run. Returns the number of groups that failed.
+    """
+    merged = load_manifest(bucket, collection_name)
+    today = datetime.now(tz=timezone.utc).strftime('%Y-%m-%d')
+    pattern = _batch_file_pattern(collection_name)
+
+    listed = set()
+    groups = defaultdict(list)
+    for blob in get_storage_client().list_blobs(bucket, prefix=f"{collection_name}/"):
+        match = pattern.fullmatch(blob.name)
+        if not match:
+            continue
+        listed.add(blob.name)
+        if blob.name in merged:
+            continue
+        date = _partition_date(match.group('seconds'))
+        # Today's partition may still receive files
+        if date >= today:
+            continue
+        groups[(date, match.group('format'))].append(blob)
+
+    # Sources that were deleted once merged can't be merged again, so the manifest stops tracking them
+    deleted = merged.keys() - listed
+    if deleted:
+        merged = {name: destination for name, destination in merged.items() if name in listed}
+        save_manifest(bucket, collection_name, merged)
+
+    failed = 0
+    for (date, file_format), blobs in sorted(groups.items()):
+        blobs.sort(key=lambda blob: blob.name)
+        for sources in _chunk_by_size(blobs, target_size):
+            destination_name = _destination_name(collection_name, date, file_format, sources)
+            try:
+                if not bucket.blob(destination_name).exists():
+                    logger.info(f"Merging {len(sources)} files into {destination_name}")
+                    if file_format == 'ndjson':
+                        _compose(bucket, sources, destination_name)
+                    else:
+                        _rewrite(bucket, sources, destination_name)
+            except Exception:
+                logger.exception(f"Failed to merge {len(sources)} files into {destination_name}, skipping them")
+                failed += 1
+                continue
+
+            for blob in sources:
+                merged[blob.name] = destination_name
+            save_manifest(bucket, collection_name, merged)
+
+            if COMPACTION_DELETE_SOURCES:
+                for blob in sources:
+                    blob.delete()
+    return failed
+
+
+def compact_collections(bucket_name: str = BUCKET_NAME):
+    """Compacts every collection, failing once they are all done if any group of files couldn't be merged"""
+    bucket = get_storage_client().bucket(bucket_name)
+    failed = 0
+    for prefix in list_collection_prefixes(bucket_name):
+        collection_name = prefix.rstrip('/')
+        logger.info(f"Compacting collection {collection_name}")
+        failed += compact_collection(bucket, collection_name)
+    if failed:
+        raise RuntimeError(f"{failed} groups of files failed to merge")
+
+
+if __name__ == '__main__':
+    configure_logging()
+    compact_collections()
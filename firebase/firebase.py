@@ -1,51 +1,113 @@
+import functools
 import json
 import logging
 import logging.config
 import os
+import socket
+import threading
 import time
+import uuid
 from datetime import datetime
-from typing import Any, List
+from typing import TYPE_CHECKING, Any, Callable, List, Tuple
 
-import firebase_admin
-from firebase_admin import firestore
-from google.cloud import storage
-from google.cloud.firestore_v1.base_document import DocumentSnapshot
-from google.cloud.firestore_v1.collection import CollectionReference
+from governor import MemoryGovernor, estimate_size
+from jobs import FAILED, SUCCEEDED, Job
+from leases import LEASE_COLLECTION, LeaseManager
+from offsets import (OFFSET_COLLECTION, FirestoreOffsetStore, GCSOffsetStore,
+                     OffsetStore, SQLiteOffsetStore)
+from popl import metrics, profiling
 
-log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logging.conf')
-print(log_file_path)
-logging.config.fileConfig(fname=log_file_path, disable_existing_loggers=False)
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1.base_document import DocumentSnapshot
+    from google.cloud.firestore_v1.collection import CollectionReference
 
-# Get the logger specified in the file
 logger = logging.getLogger(__name__)
 
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 DEFAULT_BATCH_SIZE = int(os.getenv("DEFAULT_BATCH_SIZE"))
 MAX_RUN_TIME = int(os.getenv("MAX_RUN_TIME"))
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", 128 * 1024 * 1024))
+MIN_BATCH_SIZE = int(os.getenv("MIN_BATCH_SIZE", 50))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 5000))
+TARGET_PAGE_LATENCY = float(os.getenv("TARGET_PAGE_LATENCY", 10))
+# Format of the uploaded files, either "json" (a json array) or "ndjson" (one document per line)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "json")
 COLLECTIONS = ['people', 'purchases', 'activationLocation']
-OFFSET_COLLECTION = "offset_collection"
-OFFSET_COLLECTION_KEY = 'offset'
+# Prefix in the bucket that profiling artifacts are uploaded to
+PROFILES_PREFIX = "_profiles"
+# Where offsets are stored, one of "firestore", "gcs" or "sqlite"
+OFFSET_BACKEND = os.getenv("OFFSET_BACKEND", "firestore")
+OFFSET_GCS_OBJECT = os.getenv("OFFSET_GCS_OBJECT", "_offsets.json")
+OFFSET_SQLITE_PATH = os.getenv("OFFSET_SQLITE_PATH", "offsets.db")
+# Seconds a shard lease is valid for without being renewed
+LEASE_DURATION = int(os.getenv("LEASE_DURATION", 600))
+# Maximum number of shards (collections) a single run exports, defaults to all of them
+MAX_SHARDS_PER_RUN = int(os.getenv("MAX_SHARDS_PER_RUN", len(COLLECTIONS)))
+# Offset key used (starting from 0) for collections that don't have an offset yet
+DEFAULT_OFFSET_KEY = os.getenv("DEFAULT_OFFSET_KEY")
 
-# Initialize firebase app
-firebase_admin.initialize_app()
 
-# Instantiate clients
-db = firestore.client()
-storage_client = storage.Client()
+def configure_logging():
+    """Loads the logging config, only needed when running this module directly"""
+    log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logging.conf')
+    logging.config.fileConfig(fname=log_file_path, disable_existing_loggers=False)
 
 
-def get_collection_documents(collection_name: str, query_field: str, query_value: Any, query_sign=">=") -> list:
+def _initialize_once(func: Callable) -> Callable:
+    """Caches the result of an initializer so it only runs once, even across threads"""
+    lock = threading.Lock()
+    result = []
+
+    @functools.wraps(func)
+    def wrapper():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(func())
+        return result[0]
+
+    return wrapper
+
+
+# The firebase app and clients are created on first use rather than at import
+# time so the service starts (and cold starts) without loading credentials
+@_initialize_once
+def get_firebase_app():
+    import firebase_admin
+    return firebase_admin.initialize_app()
+
+
+@_initialize_once
+def get_db():
+    from firebase_admin import firestore
+    return firestore.client(get_firebase_app())
+
+
+@_initialize_once
+def get_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+def get_collection_documents(collection_name: str, query_field: str, query_value: Any, query_sign=">=",
+                             limit: int = None, start_after: 'DocumentSnapshot' = None) -> list:
     """Gets documents from a firebase collection"""
-    return db.collection(collection_name).where(query_field, query_sign, query_value).order_by(query_field).get()
+    query = get_db().collection(collection_name).where(query_field, query_sign, query_value).order_by(query_field)
+    if start_after is not None:
+        query = query.start_after(start_after)
+    if limit is not None:
+        query = query.limit(limit)
+    with metrics.current().timer('firestore_page'):
+        return query.get()
 
 
-def get_subcollection_references(document: DocumentSnapshot) -> CollectionReference:
+def get_subcollection_references(document: 'DocumentSnapshot') -> 'CollectionReference':
     """Gets subcollection reference from a document"""
 
     return document.reference.collections()
 
 
-def process_subcollection_documents(documents: List[CollectionReference], parent_document_id: str) -> list:
+def process_subcollection_documents(documents: List['CollectionReference'], parent_document_id: str) -> list:
     """Prepare and process documents from a subcollection"""
     subcollections = []
     for document in documents:
@@ -78,8 +140,7 @@ def _upload_blob(bucket_name: str, source_file_name: str, destination_blob_name:
     # The ID of your GCS object
     # destination_blob_name = "storage-object-name"
 
-    # storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
 
     blob.upload_from_filename(source_file_name)
@@ -89,14 +150,19 @@ def _upload_blob(bucket_name: str, source_file_name: str, destination_blob_name:
 
 def _generate_filename(collection_name: str) -> str:
     """Generates a filename"""
-    return f"collection_{collection_name}_{_get_timestamp_string()}.json"
+    return f"collection_{collection_name}_{_get_timestamp_string()}.{OUTPUT_FORMAT}"
 
 
 def _write_file(filename: str, data: list):
-    """Writes a json file to local file system"""
+    """Writes a json or ndjson file to local file system"""
     with open(filename, 'w') as f:
         logger.info(f"Writing collection to file {filename}")
-        json.dump(data, f)
+        if OUTPUT_FORMAT == 'ndjson':
+            for record in data:
+                f.write(json.dumps(record))
+                f.write('\n')
+        else:
+            json.dump(data, f)
 
 
 def _remove_file(filename):
@@ -117,42 +183,40 @@ def _get_timestamp_string():
     return str(datetime.utcnow().timestamp()).replace('.', '_')
 
 
-def _format_offset_id(collection_name: str) -> str:
-    """Takes a collection name and formats it to be used as a document ID"""
-    return f"{collection_name}_offset_id"
-
-
 def batch_upload(bucket_name: str, data: list, collection_name: str):
+    run_metrics = metrics.current()
     filename = _generate_filename(collection_name)
-    _write_file(filename, data)
-    _upload_blob(bucket_name, filename, f"{collection_name}/{filename}")
+    with run_metrics.timer('serialize'):
+        _write_file(filename, data)
+    run_metrics.incr('uploaded_bytes', os.path.getsize(filename))
+    run_metrics.incr('uploaded_files')
+    with run_metrics.timer('upload'):
+        _upload_blob(bucket_name, filename, f"{collection_name}/{filename}")
     _remove_file(filename)
 
 
-def process_subcollections(document: DocumentSnapshot) -> list:
-    subcollection_references = get_subcollection_references(document)
-    return process_subcollection_documents(subcollection_references, document.id)
+def process_subcollections(document: 'DocumentSnapshot') -> list:
+    with metrics.current().timer('subcollection_fetch'):
+        subcollection_references = get_subcollection_references(document)
+        return process_subcollection_documents(subcollection_references, document.id)
 
 
-def process_documents(bucket_name: str, documents: List[DocumentSnapshot], collection_name: str, offset_key: str, offset: Any) -> Any:
-    """Prepare and process documents form a collection"""
+def process_document(document: 'DocumentSnapshot') -> Tuple[dict, list]:
+    """Prepare a document and its subcollections for upload"""
+    record = {
+        'id': document.id,
+        'data': document.to_dict(),
+    }
+    return record, process_subcollections(document)
 
-    collection_documents = []
-    subcollection_documents = []
-    for document in documents:
-        data = document.to_dict()
-        # Get offset from document, default to current offset if no offset
-        doc_offset = data.get(offset_key, offset)
-        collection_documents.append({
-            'id': document.id,
-            'data': data,
-        })
 
-        # Update the latest offset
-        offset = max(offset, doc_offset)
+def flush_documents(bucket_name: str, collection_documents: list, subcollection_documents: list, collection_name: str,
+                    heartbeat: Callable[[], bool] = None) -> bool:
+    """Uploads buffered documents and subcollection documents, calling `heartbeat` before each upload
 
-        subcollections = process_subcollections(document)
-        subcollection_documents.extend(subcollections)
+    Returns False, leaving the remaining documents unuploaded, as soon as
+    `heartbeat` reports that the lease on the collection is lost.
+    """
 
     # Splits different types of subcollections into their
     # own file if there is more than one type of collection
@@ -161,63 +225,221 @@ def process_documents(bucket_name: str, documents: List[DocumentSnapshot], colle
         data = [col for col in subcollection_documents if col.get('name') == subcollection_name]
         if len(data) == 0:
             continue
+        if heartbeat and not heartbeat():
+            return False
         batch_upload(bucket_name, data, subcollection_name)
 
-    batch_upload(bucket_name, collection_documents, collection_name)
+    if collection_documents:
+        if heartbeat and not heartbeat():
+            return False
+        batch_upload(bucket_name, collection_documents, collection_name)
+    return True
 
-    return offset
 
+def batch_process(bucket_name: str, collection_name: str, start_time: float, offset_store: OffsetStore,
+                  lease_manager: LeaseManager, job: Job = None):
+    offset_dict = get_latest_offset(offset_store, collection_name)
+    if not offset_dict:
+        logger.warning(f"Skipping collection {collection_name}")
+        if job:
+            job.update_collection(collection_name, status=SUCCEEDED)
+        return
 
-def batch_process(bucket_name: str, collection_name: str, start_time: float):
-    offset_dict = get_latest_offset(collection_name)
-    if offset_dict:
-        offset_key = list(offset_dict.keys())[0]
-        offset = offset_dict[offset_key]
-    else:
-        raise Exception(f'No offset found for collection {collection_name}')
+    offset_key = list(offset_dict.keys())[0]
+    offset = offset_dict[offset_key]
+
+    run_metrics = metrics.current()
+    governor = MemoryGovernor(collection_name, MEMORY_BUDGET_BYTES, DEFAULT_BATCH_SIZE,
+                              MIN_BATCH_SIZE, MAX_BATCH_SIZE, TARGET_PAGE_LATENCY)
+    start_offset = offset
+    last_document = None
+    total_documents = 0
+    collection_documents = []
+    subcollection_documents = []
+
+    def lease_lost() -> bool:
+        # Renewals are throttled by the lease manager, so this is cheap to call per document
+        if collection_name in lease_manager.heartbeat():
+            return False
+        logger.warning(f"Lease on collection {collection_name} lost, stopping without saving its offset")
+        offset_store.discard(collection_name)
+        if job:
+            job.update_collection(collection_name, status=FAILED)
+        return True
 
     logger.info(f"Getting documents for collection {collection_name}")
-    documents = get_collection_documents(collection_name, offset_key, offset)
-    if len(documents) == 0:
+    while True:
+        if lease_lost():
+            return
+
+        page_size = governor.page_size
+        read_start = time.time()
+        documents = get_collection_documents(collection_name, offset_key, start_offset,
+                                             limit=page_size, start_after=last_document)
+        read_latency = time.time() - read_start
+
+        for document in documents:
+            if lease_lost():
+                return
+            record, subcollections = process_document(document)
+            collection_documents.append(record)
+            subcollection_documents.extend(subcollections)
+            size = estimate_size(record) + estimate_size(subcollections)
+            governor.add(size)
+            run_metrics.incr('documents')
+            run_metrics.incr('document_bytes', size)
+
+            # Get offset from document, default to current offset if no offset
+            offset = max(offset, record['data'].get(offset_key, offset))
+
+            if governor.should_flush():
+                logger.info(f"Memory budget reached for collection {collection_name}, "
+                            f"flushing {governor.buffered_documents} documents ({governor.buffered_bytes} bytes)")
+                if not flush_documents(bucket_name, collection_documents, subcollection_documents, collection_name,
+                                       heartbeat=lambda: not lease_lost()):
+                    return
+                collection_documents = []
+                subcollection_documents = []
+                governor.reset()
+                if not save_offset(offset_store, lease_manager, collection_name, offset_key, offset):
+                    logger.warning(f"Lease on collection {collection_name} lost, stopping without saving its offset")
+                    if job:
+                        job.update_collection(collection_name, status=FAILED)
+                    return
+
+        total_documents += len(documents)
+        governor.record_page(len(documents), read_latency)
+        if job:
+            job.update_collection(collection_name, documents=total_documents, bytes=governor.total_bytes, offset=offset)
+
+        if len(documents) < page_size:
+            break
+
+        last_document = documents[-1]
+        if (time.time() - start_time >= MAX_RUN_TIME):
+            logger.info(f"Job runtime {time.time() - start_time} approaching MAX_RUN_TIME limit")
+            break
+
+    if total_documents == 0:
         logger.info(f"No more documents to process for collection {collection_name}")
+        if job:
+            job.update_collection(collection_name, status=SUCCEEDED)
         return
 
-    offset = process_documents(bucket_name, documents, collection_name, offset_key, offset)
-
-    if (time.time() - start_time >= MAX_RUN_TIME):
-        logger.info(f"Job runtime {time.time() - start_time} approaching MAX_RUN_TIME limit")
-        set_latest_offset(collection_name, offset_key, offset)
+    if not flush_documents(bucket_name, collection_documents, subcollection_documents, collection_name,
+                           heartbeat=lambda: not lease_lost()):
         return
 
-    logger.info(f"Finished processing documents for collection {collection_name}")
+    logger.info(f"Finished processing {total_documents} documents for collection {collection_name}")
     logger.info(f"Saving offset {offset_key} with offset {offset}...")
-    set_latest_offset(collection_name, offset_key, offset)
+    if not save_offset(offset_store, lease_manager, collection_name, offset_key, offset):
+        logger.warning(f"Lease on collection {collection_name} lost, its offset wasn't saved")
+        if job:
+            job.update_collection(collection_name, status=FAILED)
+        return
+    if job:
+        job.update_collection(collection_name, status=SUCCEEDED, offset=offset)
 
 
-def get_latest_offset(collection_name: str) -> dict:
+def get_latest_offset(offset_store: OffsetStore, collection_name: str) -> dict:
     """Fetches the last offset to sync records from that point on"""
-    offset_id = _format_offset_id(collection_name)
-    doc = db.collection(OFFSET_COLLECTION).document(offset_id).get()
-    if doc.exists:
+    offset = offset_store.get(collection_name)
+    if offset:
         logger.info(f"Found offset for collection {collection_name}")
-        return doc.to_dict()
+        return offset
+    elif DEFAULT_OFFSET_KEY:
+        logger.warning(f"No offset found for collection {collection_name} in the {OFFSET_BACKEND} offset store. Using 0 as default offset")
+        return {DEFAULT_OFFSET_KEY: 0}
     else:
-        logger.warning(f"No offset found for collection {collection_name} in the {OFFSET_COLLECTION} collection. Using 0 as default offset")
+        logger.warning(f"No offset found for collection {collection_name} in the {OFFSET_BACKEND} offset store and no DEFAULT_OFFSET_KEY set")
         return None
 
 
-def set_latest_offset(collection_name: str, offset_key:str, offset: Any):
-    """Save the latest offset used"""
-    offset_id = _format_offset_id(collection_name)
-    data = {offset_key: offset}
-    db.collection(OFFSET_COLLECTION).document(offset_id).set(data)
+def set_latest_offset(offset_store: OffsetStore, collection_name: str, offset_key: str, offset: Any):
+    """Save the latest offset used, it is written when the offset store is committed"""
+    offset_store.set(collection_name, offset_key, offset)
+
+
+def save_offset(offset_store: OffsetStore, lease_manager: LeaseManager, collection_name: str, offset_key: str,
+                offset: Any) -> bool:
+    """Commits the offset of a collection once its documents are uploaded
+
+    Offsets are written after every flush so a run that is killed midway
+    resumes from its last flush. Returns False without saving the offset
+    when the lease on the collection was lost.
+    """
+    if collection_name not in lease_manager.heartbeat():
+        offset_store.discard(collection_name)
+        return False
+
+    set_latest_offset(offset_store, collection_name, offset_key, offset)
+    with metrics.current().timer('offset_commit'):
+        offset_store.commit()
+    return True
+
+
+def create_offset_store() -> OffsetStore:
+    """Creates the offset store for the configured OFFSET_BACKEND"""
+    if OFFSET_BACKEND == 'gcs':
+        return GCSOffsetStore(get_storage_client().bucket(BUCKET_NAME), OFFSET_GCS_OBJECT)
+    elif OFFSET_BACKEND == 'sqlite':
+        return SQLiteOffsetStore(OFFSET_SQLITE_PATH)
+    elif OFFSET_BACKEND == 'firestore':
+        return FirestoreOffsetStore(get_db(), OFFSET_COLLECTION)
+    raise ValueError(f"Unknown OFFSET_BACKEND {OFFSET_BACKEND}")
 
 
-def load_firebase_collections():
+def _run_owner() -> str:
+    """Identifies this run when holding shard leases"""
+    instance = os.getenv("K_REVISION", socket.gethostname())
+    return f"{instance}-{uuid.uuid4().hex[:8]}"
+
+
+def load_firebase_collections(job: Job = None, profile: bool = False):
+    """Exports every collection, reporting progress to `job` when it runs as a background job
+
+    When `profile` is set, or the PROFILE env var is, the run is profiled and
+    the artifacts are uploaded to the bucket under PROFILES_PREFIX.
+    """
+    with metrics.run('load_firebase_collections', log=logger.info) as run_metrics:
+        if job:
+            job.metrics = run_metrics
+
+        if not (profile or profiling.profiling_requested()):
+            _load_firebase_collections(job)
+            return
+
+        with profiling.profile('load_firebase_collections', profiling.gcs_writer(BUCKET_NAME, PROFILES_PREFIX)):
+            _load_firebase_collections(job)
+
+
+def _load_firebase_collections(job: Job = None):
     start_time = time.time()
-    for collection_name in COLLECTIONS:
-        batch_process(BUCKET_NAME, collection_name, start_time)
+    lease_manager = LeaseManager(get_db(), _run_owner(), LEASE_DURATION, LEASE_COLLECTION)
+    shards = lease_manager.acquire_all(COLLECTIONS, limit=MAX_SHARDS_PER_RUN)
+    if not shards:
+        logger.info("All collections are leased by other runs, nothing to do")
+        return
+
+    offset_store = create_offset_store()
+    try:
+        # Offsets are loaded once the leases are held so they can't be stale
+        offset_store.load(shards)
+        for collection_name in shards:
+            batch_process(BUCKET_NAME, collection_name, start_time, offset_store, lease_manager, job)
+    finally:
+        # Offsets are committed as documents are uploaded, this only
+        # writes whatever is still pending if we hold the lease on its
+        # collection
+        held = lease_manager.heartbeat(force=True)
+        for collection_name in shards:
+            if collection_name not in held:
+                offset_store.discard(collection_name)
+        with metrics.current().timer('offset_commit'):
+            offset_store.commit()
+        lease_manager.release_all()
 
 
 if __name__ == '__main__':
+    configure_logging()
     load_firebase_collections()
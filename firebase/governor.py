@@ -0,0 +1,102 @@
+import datetime
+import logging
+import sys
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Rough per-object overhead used when sizing values we can't measure directly
+# (GeoPoints, DocumentReferences, ...)
+_OBJECT_OVERHEAD = 64
+
+
+def estimate_size(value: Any) -> int:
+    """Estimates the in-memory size in bytes of a firestore document value"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return sys.getsizeof(value)
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        size = sys.getsizeof(value)
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+        return size
+    if isinstance(value, (list, tuple)):
+        size = sys.getsizeof(value)
+        for item in value:
+            size += estimate_size(item)
+        return size
+    if isinstance(value, datetime.datetime):
+        return sys.getsizeof(value)
+    return _OBJECT_OVERHEAD
+
+
+class MemoryGovernor:
+    """Tracks the size of buffered documents for a collection and picks page sizes.
+
+    Documents are added to the governor as they are buffered. Once the buffered
+    size reaches the memory budget the caller should flush the buffer. After each
+    page is read the next page size is adapted to the observed document size and
+    read latency.
+    """
+
+    def __init__(self, collection_name: str, memory_budget: int, batch_size: int,
+                 min_batch_size: int, max_batch_size: int, target_page_latency: float):
+        self.collection_name = collection_name
+        self.memory_budget = memory_budget
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_page_latency = target_page_latency
+        self.page_size = self._clamp(batch_size)
+        self.buffered_bytes = 0
+        self.buffered_documents = 0
+        self._total_bytes = 0
+        self._total_documents = 0
+
+    def _clamp(self, page_size: int) -> int:
+        return max(self.min_batch_size, min(self.max_batch_size, int(page_size)))
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    @property
+    def average_document_size(self) -> float:
+        if not self._total_documents:
+            return 0
+        return self._total_bytes / self._total_documents
+
+    def add(self, size: int):
+        """Records a buffered document of `size` bytes"""
+        self.buffered_bytes += size
+        self.buffered_documents += 1
+        self._total_bytes += size
+        self._total_documents += 1
+
+    def should_flush(self) -> bool:
+        return self.buffered_bytes >= self.memory_budget
+
+    def reset(self):
+        """Resets the buffer counters after a flush"""
+        self.buffered_bytes = 0
+        self.buffered_documents = 0
+
+    def record_page(self, num_documents: int, latency: float) -> int:
+        """Adapts the next page size to the last page read and returns it"""
+        page_size = self.page_size
+
+        # Keep a full page (plus whatever is already buffered) within the budget
+        if self.average_document_size:
+            available = max(self.memory_budget - self.buffered_bytes, self.memory_budget // 2)
+            page_size = min(page_size * 2, available / self.average_document_size)
+
+        # Shrink pages that take too long to read so we check MAX_RUN_TIME often enough
+        if num_documents and latency > self.target_page_latency:
+            page_size = min(page_size, self.page_size * self.target_page_latency / latency)
+
+        self.page_size = self._clamp(page_size)
+        logger.info(
+            f"Collection {self.collection_name}: read {num_documents} documents in {latency:.2f}s, "
+            f"average document size {self.average_document_size:.0f} bytes, next page size {self.page_size}"
+        )
+        return self.page_size
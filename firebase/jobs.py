@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class Job:
+    """A background job and the progress it reports for each collection"""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = QUEUED
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Set by the job to the metrics of its run
+        self.metrics = None
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def update_collection(self, collection_name: str, status: str = None, documents: int = None,
+                          bytes: int = None, offset: Any = None):
+        """Records the progress of a collection, called by the job while it runs"""
+        with self._lock:
+            progress = self._collections.setdefault(collection_name, {
+                'status': RUNNING,
+                'documents': 0,
+                'bytes': 0,
+                'offset': None,
+                'started_at': time.time(),
+                'finished_at': None,
+            })
+            if status is not None:
+                progress['status'] = status
+                if status in (SUCCEEDED, FAILED):
+                    progress['finished_at'] = time.time()
+            if documents is not None:
+                progress['documents'] = documents
+            if bytes is not None:
+                progress['bytes'] = bytes
+            if offset is not None:
+                progress['offset'] = offset
+
+    def failed_collections(self) -> List[str]:
+        with self._lock:
+            return [name for name, progress in self._collections.items() if progress['status'] == FAILED]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            collections = {}
+            for collection_name, progress in self._collections.items():
+                elapsed = (progress['finished_at'] or time.time()) - progress['started_at']
+                collections[collection_name] = {
+                    'status': progress['status'],
+                    'documents': progress['documents'],
+                    'bytes': progress['bytes'],
+                    # Offsets may be firestore timestamps
+                    'offset': None if progress['offset'] is None else str(progress['offset']),
+                    'elapsed_seconds': round(elapsed, 3),
+                    'documents_per_second': round(progress['documents'] / elapsed, 2) if elapsed else 0,
+                    'bytes_per_second': round(progress['bytes'] / elapsed, 2) if elapsed else 0,
+                }
+
+        return {
+            'job_id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'collections': collections,
+            'metrics': self.metrics.summary() if self.metrics else None,
+        }
+
+
+class JobAlreadyActive(Exception):
+    """Raised when a job with the same name is already queued or running"""
+
+    def __init__(self, job: Job):
+        super().__init__(f"job {job.name} is already {job.status} with id {job.id}")
+        self.job = job
+
+
+class JobRunner:
+    """Runs jobs on an in-process thread pool
+
+    At most `max_workers` jobs run at once, others wait in the queue. A job
+    is only queued when no job with the same name is queued or running, so
+    triggers that fire faster than the jobs finish don't pile up. The last
+    `max_jobs_kept` jobs are kept around so their status can be queried.
+    """
+
+    def __init__(self, max_workers: int, max_jobs_kept: int = 100):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._max_jobs_kept = max_jobs_kept
+        self._lock = threading.Lock()
+
+    def submit(self, name: str, func: Callable[[Job], None]) -> Job:
+        """Queues `func`, which is called with the job to report its progress
+
+        Raises JobAlreadyActive with the existing job when one named `name`
+        is queued or running.
+        """
+        job = Job(name)
+        with self._lock:
+            active = self._active(name)
+            if active is not None:
+                raise JobAlreadyActive(active)
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._max_jobs_kept:
+                # Never forget about a job that hasn't finished
+                oldest = next((job_id for job_id, kept in self._jobs.items() if kept.status in (SUCCEEDED, FAILED)),
+                              None)
+                if oldest is None:
+                    break
+                del self._jobs[oldest]
+        self._executor.submit(self._run, job, func)
+        logger.info(f"Queued job {name} with id {job.id}")
+        return job
+
+    def _active(self, name: str) -> Optional[Job]:
+        for job in self._jobs.values():
+            if job.name == name and job.status in (QUEUED, RUNNING):
+                return job
+        return None
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, func: Callable[[Job], None]):
+        job.status = RUNNING
+        job.started_at = time.time()
+        logger.info(f"Running job {job.name} with id {job.id}")
+        try:
+            func(job)
+            # A collection fails without raising, such as when its lease is lost
+            failed = job.failed_collections()
+            if failed:
+                logger.error(f"Job {job.name} with id {job.id} failed for collections {', '.join(failed)}")
+                job.status = FAILED
+                job.error = f"collections failed: {', '.join(failed)}"
+            else:
+                job.status = SUCCEEDED
+        except Exception as e:
+            logger.error(f"Job {job.name} with id {job.id} failed\n{traceback.format_exc()}")
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
@@ -0,0 +1,101 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+LEASE_COLLECTION = "lease_collection"
+
+
+def _run_transaction(db, func: Callable, *args) -> Any:
+    """Runs `func(transaction, *args)` in a firestore transaction, retrying on contention"""
+    # Imported here so importing this module doesn't load the firestore client
+    from google.cloud.firestore_v1 import transactional
+    return transactional(func)(db.transaction(), *args)
+
+
+def _acquire_lease(transaction, reference, owner: str, duration: int) -> bool:
+    """Takes the lease if it is free, expired or already ours"""
+    snapshot = reference.get(transaction=transaction)
+    now = datetime.now(timezone.utc)
+    if snapshot.exists:
+        lease = snapshot.to_dict()
+        if lease.get('owner') != owner and lease.get('expires_at') and lease['expires_at'] > now:
+            return False
+
+    transaction.set(reference, {
+        'owner': owner,
+        'expires_at': now + timedelta(seconds=duration),
+    })
+    return True
+
+
+def _release_lease(transaction, reference, owner: str):
+    snapshot = reference.get(transaction=transaction)
+    if snapshot.exists and snapshot.to_dict().get('owner') == owner:
+        transaction.delete(reference)
+
+
+class LeaseManager:
+    """Hands out expiring leases on shards of work stored in firestore
+
+    A shard is only processed by the run holding its lease, so overlapping
+    triggers and several instances can export disjoint shards concurrently.
+    Leases that aren't renewed expire after `duration` seconds so shards held
+    by a crashed instance are picked up again.
+    """
+
+    def __init__(self, db, owner: str, duration: int, collection: str = LEASE_COLLECTION):
+        self._db = db
+        self.owner = owner
+        self.duration = duration
+        self._collection = collection
+        self.held = set()
+        self._last_heartbeat = 0
+
+    def _reference(self, shard: str):
+        return self._db.collection(self._collection).document(f"{shard}_lease")
+
+    def acquire(self, shard: str) -> bool:
+        if _run_transaction(self._db, _acquire_lease, self._reference(shard), self.owner, self.duration):
+            logger.info(f"Acquired lease on shard {shard} for {self.owner}")
+            self.held.add(shard)
+            self._last_heartbeat = time.time()
+            return True
+        logger.info(f"Shard {shard} is leased by another run, skipping")
+        return False
+
+    def acquire_all(self, shards: Iterable[str], limit: int = None) -> List[str]:
+        """Acquires up to `limit` free shards and returns them"""
+        acquired = []
+        for shard in shards:
+            if limit is not None and len(acquired) >= limit:
+                break
+            if self.acquire(shard):
+                acquired.append(shard)
+        return acquired
+
+    def heartbeat(self, force: bool = False) -> set:
+        """Renews every held lease and returns the shards still held
+
+        Leases are renewed at most every third of their duration unless `force` is set.
+        """
+        if not force and time.time() - self._last_heartbeat < self.duration / 3:
+            return self.held
+
+        for shard in list(self.held):
+            if not _run_transaction(self._db, _acquire_lease, self._reference(shard), self.owner, self.duration):
+                logger.warning(f"Lost lease on shard {shard}")
+                self.held.discard(shard)
+        self._last_heartbeat = time.time()
+        return self.held
+
+    def release(self, shard: str):
+        _run_transaction(self._db, _release_lease, self._reference(shard), self.owner)
+        self.held.discard(shard)
+        logger.info(f"Released lease on shard {shard}")
+
+    def release_all(self):
+        for shard in list(self.held):
+            self.release(shard)
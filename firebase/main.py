@@ -2,25 +2,66 @@ import logging
 import logging.config
 import os
 
-from flask import Flask
+from flask import Flask, jsonify, request
 
+from compaction import compact_collections
 from firebase import load_firebase_collections
+from jobs import JobAlreadyActive, JobRunner
+from popl import metrics
+from popl.profiling import profiling_requested
 
 logging.config.fileConfig(fname='logging.conf', disable_existing_loggers=False)
 
 # Get the logger specified in the file
 logger = logging.getLogger(__name__)
 
+# Number of jobs that run at the same time, others are queued
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", 1))
+
 app = Flask(__name__)
+job_runner = JobRunner(MAX_CONCURRENT_JOBS)
 
 
 @app.route("/")
 def run():
 
-    logger.info("running firebase load job...")
-    load_firebase_collections()
+    logger.info("queueing firebase load job...")
+    profile = profiling_requested(request)
+    return _submit("load_firebase_collections", lambda job: load_firebase_collections(job, profile=profile))
+
+
+@app.route("/compact")
+def compact():
+
+    logger.info("queueing compaction job...")
+    return _submit("compact_collections", lambda job: compact_collections())
+
+
+def _submit(name, func):
+    try:
+        job = job_runner.submit(name, func)
+    except JobAlreadyActive as e:
+        # The trigger fired again before the last job finished, point at that job instead of queueing another.
+        # This isn't an error, the scheduler would retry it
+        logger.info(str(e))
+        return jsonify({"job_id": e.job.id, "status": e.job.status}), 202
+
+    return jsonify({"job_id": job.id}), 202
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({"error": f"job {job_id} not found"}), 404
+
+    return jsonify(job.to_dict()), 200
+
 
-    return ("", 204)
+@app.route("/metrics")
+def run_metrics():
+    """Metrics summary of the last finished run of each job"""
+    return jsonify(metrics.last_runs()), 200
 
 
 if __name__ == "__main__":
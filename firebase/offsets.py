@@ -0,0 +1,178 @@
+import json
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+OFFSET_COLLECTION = "offset_collection"
+OFFSET_COLLECTION_KEY = 'offset'
+
+
+def _format_offset_id(collection_name: str) -> str:
+    """Takes a collection name and formats it to be used as a document ID"""
+    return f"{collection_name}_offset_id"
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_value(value: dict) -> Any:
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, default=_encode_value)
+
+
+def _loads(data: str) -> dict:
+    return json.loads(data, object_hook=_decode_value)
+
+
+class OffsetStore(ABC):
+    """Caches the offsets of every collection for a run
+
+    All offsets are loaded with a single read when the run starts and updated
+    offsets are written back together when `commit` is called, which the
+    exporter does after every flush. Subclasses implement `_load` and `_save`
+    for a storage backend.
+    """
+
+    def __init__(self):
+        self._offsets = {}
+        self._dirty = set()
+
+    def load(self, collection_names: Iterable[str]):
+        self._offsets = self._load(list(collection_names))
+        logger.info(f"Loaded offsets for collections {sorted(self._offsets)}")
+
+    def get(self, collection_name: str) -> Optional[dict]:
+        """Returns the `{offset_key: offset}` dict of a collection"""
+        return self._offsets.get(collection_name)
+
+    def set(self, collection_name: str, offset_key: str, offset: Any):
+        self._offsets[collection_name] = {offset_key: offset}
+        self._dirty.add(collection_name)
+
+    def discard(self, collection_name: str):
+        """Drops an uncommitted offset update so it isn't written"""
+        self._dirty.discard(collection_name)
+
+    def commit(self):
+        """Writes all updated offsets in one batch"""
+        if not self._dirty:
+            return
+        offsets = {name: self._offsets[name] for name in self._dirty}
+        self._save(offsets)
+        logger.info(f"Saved offsets for collections {sorted(offsets)}")
+        self._dirty.clear()
+
+    @abstractmethod
+    def _load(self, collection_names: list) -> Dict[str, dict]:
+        """Reads the offsets of the given collections, skipping collections without one"""
+
+    @abstractmethod
+    def _save(self, offsets: Dict[str, dict]):
+        """Writes the offsets of the given collections"""
+
+
+class FirestoreOffsetStore(OffsetStore):
+    """Stores offsets as documents in the firestore offset collection"""
+
+    def __init__(self, db, collection: str = OFFSET_COLLECTION):
+        super().__init__()
+        self._db = db
+        self._collection = collection
+
+    def _reference(self, collection_name: str):
+        return self._db.collection(self._collection).document(_format_offset_id(collection_name))
+
+    def _load(self, collection_names: list) -> Dict[str, dict]:
+        references = {self._reference(name).id: name for name in collection_names}
+        offsets = {}
+        for doc in self._db.get_all([self._reference(name) for name in collection_names]):
+            if doc.exists:
+                offsets[references[doc.id]] = doc.to_dict()
+        return offsets
+
+    def _save(self, offsets: Dict[str, dict]):
+        batch = self._db.batch()
+        for collection_name, data in offsets.items():
+            batch.set(self._reference(collection_name), data)
+        batch.commit()
+
+
+class GCSOffsetStore(OffsetStore):
+    """Stores the offsets of all collections in a single json object in a bucket"""
+
+    def __init__(self, bucket, blob_name: str):
+        super().__init__()
+        self._blob = bucket.blob(blob_name)
+        self._generation = 0
+        self._stored = {}
+
+    def _read(self):
+        """Reads the offsets of every collection and the generation they were read at"""
+        if not self._blob.exists():
+            self._generation = 0
+            self._stored = {}
+            return
+        self._blob.reload()
+        self._generation = self._blob.generation
+        self._stored = _loads(self._blob.download_as_text(if_generation_match=self._generation))
+
+    def _load(self, collection_names: list) -> Dict[str, dict]:
+        self._read()
+        return {name: self._stored[name] for name in collection_names if name in self._stored}
+
+    def _save(self, offsets: Dict[str, dict]):
+        from google.api_core.exceptions import PreconditionFailed
+
+        while True:
+            data = dict(self._stored)
+            data.update(offsets)
+            try:
+                # Fails if another run updated the object since it was read
+                self._blob.upload_from_string(_dumps(data), content_type='application/json',
+                                              if_generation_match=self._generation)
+            except PreconditionFailed:
+                logger.info("Offsets object was updated by another run, merging and retrying")
+                self._read()
+                continue
+            self._generation = self._blob.generation
+            self._stored = data
+            return
+
+
+class SQLiteOffsetStore(OffsetStore):
+    """Stores offsets in a local sqlite database"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS offsets (collection_name TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+
+    def _load(self, collection_names: list) -> Dict[str, dict]:
+        placeholders = ', '.join('?' for _ in collection_names)
+        rows = self._connection.execute(
+            f"SELECT collection_name, data FROM offsets WHERE collection_name IN ({placeholders})",
+            collection_names,
+        )
+        return {name: _loads(data) for name, data in rows}
+
+    def _save(self, offsets: Dict[str, dict]):
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO offsets (collection_name, data) VALUES (?, ?)",
+                [(name, _dumps(data)) for name, data in offsets.items()],
+            )
@@ -1,3 +1,64 @@
-from popl.amazon.amazon_sp import amazon_sp_handler
-from popl.rakuten.rakuten import rakuten_handler
-from popl.tpl.tpl import tpl_handler
+import json
+import os
+
+from popl import metrics, profiling
+
+# Connectors are imported when their handler is first called so a cloud
+# function only loads the dependencies of the connector it runs
+
+# Profiles are uploaded to PROFILE_BUCKET when set, otherwise written to PROFILE_DIR
+PROFILE_BUCKET = os.getenv('PROFILE_BUCKET')
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/profiles')
+
+
+def _metrics_response(request):
+    """Returns the metrics summary of the last runs on this instance for `?metrics=true` requests"""
+    if request.args.get('metrics', '').lower() not in ('1', 'true'):
+        return None
+    return json.dumps(metrics.last_runs()), 200, {"Content-Type": "application/json"}
+
+
+def _profile_writer() -> profiling.ArtifactWriter:
+    if PROFILE_BUCKET:
+        return profiling.gcs_writer(PROFILE_BUCKET, '_profiles')
+    return profiling.directory_writer(PROFILE_DIR)
+
+
+def _profiled(name, chunks):
+    with profiling.profile(name, _profile_writer()):
+        yield from chunks
+
+
+def _handle(request, name, handler):
+    response = handler(request)
+    if profiling.profiling_requested(request):
+        # Connectors do their work while the response streams, so the profile covers the body
+        response.response = _profiled(name, response.response)
+    return response
+
+
+def amazon_sp_handler(request):
+    response = _metrics_response(request)
+    if response:
+        return response
+
+    from popl.amazon.amazon_sp import amazon_sp_handler as handler
+    return _handle(request, 'amazon_sp', handler)
+
+
+def rakuten_handler(request):
+    response = _metrics_response(request)
+    if response:
+        return response
+
+    from popl.rakuten.rakuten import rakuten_handler as handler
+    return _handle(request, 'rakuten', handler)
+
+
+def tpl_handler(request):
+    response = _metrics_response(request)
+    if response:
+        return response
+
+    from popl.tpl.tpl import tpl_handler as handler
+    return _handle(request, 'tpl', handler)
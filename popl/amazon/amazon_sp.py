@@ -1,8 +1,10 @@
 import datetime
 import json
+import logging
+import os
 import time
 from enum import Enum
-from typing import List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import backoff
 from dateutil import parser
@@ -12,36 +14,89 @@ from sp_api.base.exceptions import (SellingApiRequestThrottledException,
                                     SellingApiTemporarilyUnavailableException)
 from sp_api.base.sales_enum import Granularity
 
+from popl import metrics
+from popl.encoder import encode_response, streamed_response
+from popl.paginator import TokenPaginator
+from popl.snapshot import SnapshotDiff, snapshot_store
+
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+# Only every Nth sku is logged while fetching sales
+SALES_LOG_SAMPLE_RATE = int(os.getenv('SALES_LOG_SAMPLE_RATE', 100))
+# Seconds to wait between two per sku sales requests
+SALES_REQUEST_INTERVAL = float(os.getenv('SALES_REQUEST_INTERVAL', 2))
+# Skus that sold within this many days are queried on every run
+SKU_ACTIVE_DAYS = int(os.getenv('SKU_ACTIVE_DAYS', 30))
+# Other skus are probed once every this many days, and swept at most once every this many days when the
+# queried skus don't add up to the total units sold
+SKU_PROBE_DAYS = int(os.getenv('SKU_PROBE_DAYS', 7))
+INVENTORIES_PRIMARY_KEY = ["asin", "fnSku", "sellerSku"]
+
 
 def amazon_sp_handler(request):
     """Responds to any HTTP request.
     Args:
         request (flask.Request): HTTP request object.
     Returns:
-        The response text or any set of values that can be turned into a
-        Response object using
-        `make_response <http://flask.pocoo.org/docs/1.0/api/#flask.Flask.make_response>`.
+        A streamed flask.Response, the records are fetched while it is
+        being written.
     """
     request_json = request.get_json()
-    bookmarks = request_json.get('state', {}).get('bookmarks')
-    sales_bookmark = get_bookmark(bookmarks, 'sales')
-    now = datetime.datetime.utcnow()
-
-    state = {
-        'bookmarks': {
-            'sales': now.isoformat(),
-            'inventories': now.isoformat(),
+    return streamed_response(_amazon_sp_response(request_json))
+
+
+def _amazon_sp_response(request_json: dict) -> Iterator[str]:
+    with metrics.run('amazon_sp'):
+        bookmarks = request_json.get('state', {}).get('bookmarks')
+        sales_bookmark = get_bookmark(bookmarks, 'sales')
+        sku_activity = request_json.get('state', {}).get('sku_activity') or {}
+        sales_sweep = request_json.get('state', {}).get('sales_sweep')
+        snapshots = request_json.get('state', {}).get('snapshots') or {}
+        now = datetime.datetime.utcnow()
+
+        # Inventories are a full refresh, only the changed ones are sent
+        inventories_diff = SnapshotDiff(snapshot_store(), 'amazon_sp/inventories', INVENTORIES_PRIMARY_KEY,
+                                        snapshots.get('inventories'))
+        seller_skus = set()
+
+        def inventories() -> Iterator[dict]:
+            for record in get_inventories():
+                seller_skus.add(record.get('sellerSku'))
+                yield record
+
+        def sales() -> Iterator[dict]:
+            # Sales need every seller sku, so they are only fetched once the inventories are written
+            nonlocal sku_activity, sales_sweep
+            records, sku_activity, sales_sweep = get_sales(sales_bookmark, now, seller_skus, sku_activity,
+                                                           sales_sweep)
+            yield from records
+
+        insert = {
+            "inventories": inventories_diff.filter(inventories()),
+            "sales": sales(),
         }
-    }
 
-    inventories, seller_skus = get_inventories()
+        def delete() -> dict:
+            return {
+                "inventories": inventories_diff.deletes(),
+            }
 
-    insert = {
-        "sales": get_sales(sales_bookmark, now, seller_skus),
-        "inventories": inventories
-    }
+        def state() -> dict:
+            inventories_diff.commit()
+            return {
+                'bookmarks': {
+                    'sales': now.isoformat(),
+                    'inventories': now.isoformat(),
+                },
+                'sku_activity': sku_activity,
+                'sales_sweep': sales_sweep,
+                'snapshots': {
+                    'inventories': inventories_diff.version,
+                },
+            }
 
-    return assemble_response_json(insert, state), 200, {"Content-Type": "application/json"}
+        yield from assemble_response_json(insert, state, delete)
 
 
 def log_backoff(details):
@@ -57,35 +112,37 @@ def log_backoff(details):
                       SellingApiTemporarilyUnavailableException),
                       max_tries=3,
                       on_backoff=log_backoff)
-def get_inventories() -> Tuple[List, List]:
-    client = Inventories()
-    paginate = True
-    next_token = None
-    seller_skus = set()
-    payload = []
-
-    while paginate:
-        response = client.get_inventory_summary_marketplace(details=True, nextToken=next_token)
-        seller_skus = seller_skus.union(get_seller_skus(response.payload['inventorySummaries']))
-        if response.pagination:
-            next_token = response.pagination.get("nextToken")
-        else:
-            next_token = None
-        paginate = True if next_token else False
-        payload.extend(response.payload['inventorySummaries'])
+def _get_inventory_page(client: Inventories, next_token: str = None):
+    with metrics.current().timer('sp_api.get_inventory_summary_marketplace'):
+        return client.get_inventory_summary_marketplace(details=True, nextToken=next_token)
+
 
-    return (payload, seller_skus)
+def get_inventories() -> Iterator[dict]:
+    """Streams the inventory summaries, following the next page tokens
+
+    sp_api signs its own requests, so pages are fetched with its client
+    rather than the shared HTTP transport.
+    """
+    client = Inventories()
+    return TokenPaginator(lambda next_token: _get_inventory_page(client, next_token),
+                          lambda response: response.payload['inventorySummaries'],
+                          lambda response: (response.pagination or {}).get('nextToken')).records()
 
 
-def get_sales(start_date: datetime.datetime, end_date: datetime.datetime, seller_skus: set) -> List:
+def get_sales(start_date: datetime.datetime, end_date: datetime.datetime, seller_skus: set,
+              sku_activity: dict, last_sweep: Optional[str] = None) -> Tuple[List, dict, Optional[str]]:
     """Get aggregated sales info.
     Docs: https://github.com/amzn/selling-partner-api-docs/blob/8438231aefe8dfbdf7c1758ddf137a0c728bb21b/references/sales-api/sales.md#getordermetricsresponse
+
+    Sales are only fetched per sku for skus that are likely to have sold, see
+    `_get_sales`. Returns the sales records, the updated sku activity index
+    and the date of the last sweep of the inactive skus.
     """
 
     print("getting sales data...")
     interval = create_date_interval(start_date, end_date)
 
-    return _get_sales(interval, Granularity.HOUR, seller_skus)
+    return _get_sales(interval, Granularity.HOUR, seller_skus, sku_activity, end_date.date(), last_sweep)
 
 
 @backoff.on_exception(backoff.expo,
@@ -94,52 +151,118 @@ def get_sales(start_date: datetime.datetime, end_date: datetime.datetime, seller
                       SellingApiTemporarilyUnavailableException),
                       max_tries=3,
                       on_backoff=log_backoff)
-def _get_sales(interval: Tuple, granularity: Enum, seller_skus: List) -> List:
+def _get_order_metrics(client: Sales, interval: Tuple, granularity: Enum, sku: str = None) -> List:
+    kwargs = {'sku': sku} if sku else {}
+    with metrics.current().timer('sp_api.get_order_metrics'):
+        return client.get_order_metrics(interval=interval, granularity=granularity, **kwargs).payload
+
+
+def _unit_count(payload: List) -> int:
+    return sum(record.get('unitCount', 0) for record in payload)
+
+
+def _is_active(activity: list, today: datetime.date) -> bool:
+    """Whether a sku sold recently, was never seen before or is due a probe"""
+    if not activity:
+        return True
+    last_sale, last_probe = activity
+    if last_sale and (today - datetime.date.fromisoformat(last_sale)).days <= SKU_ACTIVE_DAYS:
+        return True
+    return not last_probe or (today - datetime.date.fromisoformat(last_probe)).days >= SKU_PROBE_DAYS
+
+
+def _sweep_due(last_sweep: Optional[str], today: datetime.date) -> bool:
+    return not last_sweep or (today - datetime.date.fromisoformat(last_sweep)).days >= SKU_PROBE_DAYS
+
+
+def _get_sales(interval: Tuple, granularity: Enum, seller_skus: List, sku_activity: dict,
+               today: datetime.date, last_sweep: Optional[str] = None) -> Tuple[List, dict, Optional[str]]:
+    """Fetches per sku sales, skipping skus that haven't sold in a while
+
+    `sku_activity` maps each sku to the `[last sale, last probe]` dates seen
+    by previous runs. The units sold by all skus are fetched first with a
+    single request. Skus that sold recently, new skus and skus due a periodic
+    probe are queried first, and the remaining skus are swept when they don't
+    add up to the total. The total also counts skus that aren't in the FBA
+    inventory, so it may never add up, and the sweep only runs when the last
+    one (`last_sweep`) is at least SKU_PROBE_DAYS old.
+    """
     client = Sales()
 
+    total_units = _unit_count(_get_order_metrics(client, interval, Granularity.TOTAL))
+    print(f"{total_units} units sold across all skus")
+
+    seller_skus = [sku for sku in seller_skus if sku]
+    # Only keep skus that are still in the inventory
+    activity = {sku: sku_activity.get(sku) for sku in seller_skus}
+    if total_units == 0:
+        return [], activity, last_sweep
+
+    active_skus = [sku for sku in seller_skus if _is_active(activity[sku], today)]
+    inactive_skus = [sku for sku in seller_skus if not _is_active(activity[sku], today)]
+    print(f"Querying sales for {len(active_skus)} active skus, skipping {len(inactive_skus)} inactive skus")
+
     records = []
     num_seller_skus = len(seller_skus)
-    for idx, sku in enumerate(seller_skus, start=1):
-        if not sku:
-            continue
-        print(f"Getting sales data for sellerSku: {sku} ({idx}/{num_seller_skus})")
-        response = client.get_order_metrics(interval=interval, granularity=granularity, sku=sku)
+    queried = 0
+
+    def query_sku(sku: str) -> int:
+        nonlocal queried
+        queried += 1
+        sampled = (queried - 1) % SALES_LOG_SAMPLE_RATE == 0
+        if sampled:
+            logger.info(f"Getting sales data for sellerSku: {sku} ({queried}/{num_seller_skus})")
+        payload = _get_order_metrics(client, interval, granularity, sku)
 
-        for record in response.payload:
+        sku_units = _unit_count(payload)
+        last_sale = today.isoformat() if sku_units else (activity[sku] or [None])[0]
+        activity[sku] = [last_sale, today.isoformat()]
+
+        for record in payload:
             record.update({'sellerSku': sku})
             records.append(record)
 
-        sleep_time = 2
-        print(f"response:\n\t {json.dumps(response.payload, indent=2)}")
-        print("=" * 120)
-        print(f"Sleeping for {sleep_time} seconds...")
-        time.sleep(sleep_time)
-
-    return records
-
-
-def assemble_response_json(insert, state):
-    response_dict = {
-        "state": state,
-        "schema": {
-            "inventories": {
-                "primary_key": [
-                    "asin",
-                    "fnSku",
-                    "sellerSku",
-                ]
-            },
-            "sales": {
-                "primary_key": [
-                    "interval",
-                    "sellerSku"
-                ]
-            }
+        if sampled and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"response for sellerSku {sku}: {json.dumps(payload)}")
+
+        time.sleep(SALES_REQUEST_INTERVAL)
+        return sku_units
+
+    units = sum(query_sku(sku) for sku in active_skus)
+
+    swept = 0
+    if units < total_units and inactive_skus:
+        if _sweep_due(last_sweep, today):
+            print(f"Active skus sold {units} of {total_units} units, querying inactive skus")
+            last_sweep = today.isoformat()
+            for sku in inactive_skus:
+                if units >= total_units:
+                    break
+                units += query_sku(sku)
+                swept += 1
+        else:
+            print(f"Active skus sold {units} of {total_units} units, inactive skus were already swept on {last_sweep}")
+
+    run_metrics = metrics.current()
+    run_metrics.incr('swept_skus', swept)
+    run_metrics.incr('skipped_skus', num_seller_skus - queried)
+    return records, activity, last_sweep
+
+
+def assemble_response_json(insert: Dict[str, Iterable[dict]], state: Callable[[], dict],
+                           delete: Callable[[], dict] = None) -> Iterator[str]:
+    schema = {
+        "inventories": {
+            "primary_key": INVENTORIES_PRIMARY_KEY
         },
-        "insert": insert,
-        "hasMore": False
+        "sales": {
+            "primary_key": [
+                "interval",
+                "sellerSku"
+            ]
+        }
     }
-    return json.dumps(response_dict)
+    return encode_response(schema, insert, state, delete)
 
 
 def create_date_interval(start_date: datetime.datetime,
@@ -165,10 +288,6 @@ def get_bookmark(bookmarks: List, key: str) -> datetime.datetime:
     return parser.parse(bookmark)
 
 
-def get_seller_skus(payload: List) -> set:
-    return {record.get('sellerSku') for record in payload}
-
-
 if __name__ == '__main__':
     class Request:
         def __init__(self, data) -> None:
@@ -189,4 +308,4 @@ if __name__ == '__main__':
 
     request = Request(data)
     response = amazon_sp_handler(request)
-    print(response)
+    print(''.join(response.response))
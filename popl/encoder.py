@@ -0,0 +1,87 @@
+import contextvars
+import json
+import os
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from popl import metrics
+
+# Encoded records are written to the response in chunks of about this many characters
+RESPONSE_CHUNK_SIZE = int(os.getenv('RESPONSE_CHUNK_SIZE', 64 * 1024))
+
+_encoder = json.JSONEncoder()
+
+
+def encode_response(schema: dict, insert: Dict[str, Iterable[dict]], state: Callable[[], dict],
+                    delete: Optional[Callable[[], dict]] = None,
+                    chunk_size: int = RESPONSE_CHUNK_SIZE) -> Iterator[str]:
+    """Yields the Fivetran response json in chunks while the insert records are consumed
+
+    Records are encoded one at a time, so only the chunk being written is
+    held in memory. `delete` and `state` are only called once every record is
+    written, which lets them depend on what was streamed, such as a
+    snapshot diff that needs all the records before it can be committed.
+    """
+    run_metrics = metrics.current()
+    encode_seconds = 0.0
+    response_bytes = 0
+
+    # The envelope goes out right away, before the first page is fetched
+    head = f'{{"schema": {_encoder.encode(schema)}, "insert": {{'
+    response_bytes += len(head)
+    yield head
+
+    chunk = []
+    size = 0
+    for stream_idx, (stream, records) in enumerate(insert.items()):
+        chunk.append(f'{", " if stream_idx else ""}{_encoder.encode(stream)}: [')
+        count = 0
+        for record in records:
+            start = time.perf_counter()
+            data = _encoder.encode(record)
+            encode_seconds += time.perf_counter() - start
+            chunk.append(f', {data}' if count else data)
+            size += len(data) + 2
+            count += 1
+            if size >= chunk_size:
+                text = ''.join(chunk)
+                chunk, size = [], 0
+                response_bytes += len(text)
+                yield text
+        chunk.append(']')
+        run_metrics.incr(f'{stream}_records', count)
+
+    start = time.perf_counter()
+    chunk.append(f'}}, "delete": {_encoder.encode(delete() if delete else {})}')
+    chunk.append(f', "state": {_encoder.encode(state())}, "hasMore": false}}')
+    text = ''.join(chunk)
+    encode_seconds += time.perf_counter() - start
+
+    response_bytes += len(text)
+    run_metrics.observe('serialize', encode_seconds)
+    run_metrics.incr('response_bytes', response_bytes)
+    yield text
+
+
+def _in_context(chunks: Iterator[str]) -> Iterator[str]:
+    """Runs every step of `chunks` in the context the response was created in
+
+    Flask iterates the body after the handler returns, this keeps context
+    variables such as the current metrics run set and reset in one context.
+    """
+    context = contextvars.copy_context()
+    try:
+        while True:
+            try:
+                chunk = context.run(next, chunks)
+            except StopIteration:
+                return
+            yield chunk
+    finally:
+        context.run(chunks.close)
+
+
+def streamed_response(chunks: Iterator[str]):
+    """Wraps the chunks of a json body in a streamed flask Response"""
+    from flask import Response
+    return Response(_in_context(chunks), status=200, content_type='application/json')
@@ -0,0 +1,116 @@
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Metrics:
+    """Counters and per stage latency histograms for a single run"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._stages = {}
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, stage: str, seconds: float):
+        """Records one call of `stage` that took `seconds`"""
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {
+                    'count': 0,
+                    'total': 0.0,
+                    'min': seconds,
+                    'max': seconds,
+                    'buckets': [0] * len(BUCKETS),
+                }
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['min'] = min(stats['min'], seconds)
+            stats['max'] = max(stats['max'], seconds)
+            for idx, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][idx] += 1
+                    break
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        with self._lock:
+            stages = {}
+            for stage, stats in self._stages.items():
+                stages[stage] = {
+                    'count': stats['count'],
+                    'total_seconds': round(stats['total'], 6),
+                    'mean_seconds': round(stats['total'] / stats['count'], 6),
+                    'min_seconds': round(stats['min'], 6),
+                    'max_seconds': round(stats['max'], 6),
+                    'histogram': {
+                        ('+Inf' if bound == float('inf') else str(bound)): count
+                        for bound, count in zip(BUCKETS, stats['buckets']) if count
+                    },
+                }
+            counters = dict(self._counters)
+
+        return {
+            'run': self.name,
+            'started_at': self.started_at,
+            'elapsed_seconds': round(elapsed, 3),
+            'counters': counters,
+            'per_second': {name: round(value / elapsed, 2) if elapsed else 0 for name, value in counters.items()},
+            'stages': stages,
+        }
+
+    def emit(self, log: Callable[[str], None] = print):
+        """Writes the summary as a single json line"""
+        log(json.dumps({'metrics': self.summary()}))
+
+
+_current = contextvars.ContextVar('metrics', default=None)
+# Metrics recorded outside of a run end up here
+_default = Metrics('default')
+_last_runs: Dict[str, Metrics] = {}
+
+
+def current() -> Metrics:
+    """Returns the metrics of the run in progress"""
+    return _current.get() or _default
+
+
+@contextmanager
+def run(name: str, log: Callable[[str], None] = print):
+    """Collects metrics for a run and emits their summary once it finishes"""
+    metrics = Metrics(name)
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+        metrics.finished_at = time.time()
+        metrics.emit(log)
+        _last_runs[name] = metrics
+
+
+def last_runs() -> dict:
+    """Summaries of the last finished run of each name"""
+    return {name: metrics.summary() for name, metrics in _last_runs.items()}
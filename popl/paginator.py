@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import math
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional
+
+
+class Paginator(ABC):
+    """Streams the records of a paginated endpoint one page at a time
+
+    `fetch(position)` returns a page and may be a plain function or a
+    coroutine function. Plain functions run in a worker thread so they don't
+    block other requests. `get_records(page)` returns the records of a page.
+    An async context manager passed as `context`, such as a client holding an
+    HTTP session, is entered in the event loop that fetches the pages.
+    """
+
+    def __init__(self, fetch: Callable[[Any], Any], get_records: Callable[[Any], List], context=None):
+        self._fetch_page = fetch
+        self._get_records = get_records
+        self._context = context
+
+    async def _fetch(self, position):
+        if asyncio.iscoroutinefunction(self._fetch_page):
+            return await self._fetch_page(position)
+        # Keep the current run's metrics in the worker thread
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, self._fetch_page, position)
+
+    @abstractmethod
+    async def pages(self) -> AsyncIterator:
+        """Yields the pages in order, implemented as an async generator"""
+
+    async def _pages(self) -> AsyncIterator:
+        if self._context is None:
+            async for page in self.pages():
+                yield page
+            return
+        async with self._context:
+            async for page in self.pages():
+                yield page
+
+    def records(self) -> Iterator:
+        """Yields records as pages come in, only the pages being fetched are held in memory"""
+        loop = asyncio.new_event_loop()
+        pages = self._pages()
+        try:
+            while True:
+                try:
+                    page = loop.run_until_complete(pages.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield from self._get_records(page)
+        finally:
+            loop.run_until_complete(pages.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    def __iter__(self) -> Iterator:
+        return self.records()
+
+
+class TokenPaginator(Paginator):
+    """Follows the next page token returned by `get_next_token(page)` until there is none"""
+
+    def __init__(self, fetch: Callable[[Optional[str]], Any], get_records: Callable[[Any], List],
+                 get_next_token: Callable[[Any], Optional[str]], context=None):
+        super().__init__(fetch, get_records, context)
+        self._get_next_token = get_next_token
+
+    async def pages(self) -> AsyncIterator:
+        token = None
+        while True:
+            page = await self._fetch(token)
+            yield page
+            token = self._get_next_token(page)
+            if not token:
+                return
+
+
+class PageNumberPaginator(Paginator):
+    """Fetches numbered pages, starting at 1
+
+    When `get_total(page)` returns the total number of records, the number of
+    pages is known after the first page and up to `concurrency` pages are
+    fetched at a time. Pages are still yielded in order. Otherwise pages are
+    fetched one after another until one comes back short.
+    """
+    first_page = 1
+
+    def __init__(self, fetch: Callable[[int], Any], get_records: Callable[[Any], List], page_size: int,
+                 get_total: Optional[Callable[[Any], Optional[int]]] = None, concurrency: int = 1, context=None):
+        super().__init__(fetch, get_records, context)
+        self._page_size = page_size
+        self._get_total = get_total
+        self._concurrency = max(concurrency, 1)
+
+    def _position(self, index: int) -> int:
+        return self.first_page + index
+
+    async def pages(self) -> AsyncIterator:
+        page = await self._fetch(self._position(0))
+        yield page
+
+        total = self._get_total(page) if self._get_total else None
+        if total is None:
+            index = 1
+            while len(self._get_records(page)) >= self._page_size:
+                page = await self._fetch(self._position(index))
+                yield page
+                index += 1
+            return
+
+        num_pages = math.ceil(total / self._page_size)
+        next_index = 1
+        pending = deque()
+        try:
+            while next_index < num_pages or pending:
+                while next_index < num_pages and len(pending) < self._concurrency:
+                    pending.append(asyncio.ensure_future(self._fetch(self._position(next_index))))
+                    next_index += 1
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+class OffsetPaginator(PageNumberPaginator):
+    """Same as `PageNumberPaginator`, but `fetch` gets the offset of the first record of the page"""
+
+    def _position(self, index: int) -> int:
+        return index * self._page_size
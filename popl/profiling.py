@@ -0,0 +1,147 @@
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two samples of the wall clock profiler
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.01))
+# Number of frames kept for each tracemalloc allocation
+TRACEMALLOC_FRAMES = int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', 10))
+
+ArtifactWriter = Callable[[str, bytes], None]
+
+
+def profiling_requested(request=None) -> bool:
+    """Whether the PROFILE env var or a `?profile=true` request argument asks for profiling"""
+    if os.getenv('PROFILE', '').lower() in ('1', 'true'):
+        return True
+    args = getattr(request, 'args', None)
+    return bool(args) and args.get('profile', '').lower() in ('1', 'true')
+
+
+def directory_writer(path: str) -> ArtifactWriter:
+    """Writes artifacts to a local directory"""
+    def write(name: str, data: bytes):
+        filename = os.path.join(path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        logger.info(f"Wrote profile artifact {filename}")
+    return write
+
+
+def gcs_writer(bucket_name: str, prefix: str) -> ArtifactWriter:
+    """Uploads artifacts to `prefix/` in a bucket"""
+    from google.cloud import storage
+    bucket = storage.Client().bucket(bucket_name)
+
+    def write(name: str, data: bytes):
+        blob = bucket.blob(f"{prefix}/{name}")
+        blob.upload_from_string(data)
+        logger.info(f"Uploaded profile artifact gs://{bucket_name}/{blob.name}")
+    return write
+
+
+class WallClockSampler:
+    """Samples the stack of a thread at a fixed interval
+
+    Stacks are collapsed in the `frame;frame;frame count` format read by
+    flamegraph tools (flamegraph.pl, speedscope, ...).
+    """
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+
+def _cprofile_report(profiler: cProfile.Profile) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(50)
+    return output.getvalue()
+
+
+def _tracemalloc_report(snapshot: tracemalloc.Snapshot, peak: int) -> str:
+    lines = [f"peak traced memory: {peak / 1024 / 1024:.1f} MiB", "", "top allocations at the end of the run:"]
+    for stat in snapshot.statistics('traceback')[:25]:
+        lines.append(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format())
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def profile(name: str, write: ArtifactWriter):
+    """Profiles the enclosed block and writes the artifacts under `name/`
+
+    Writes cProfile stats (`.pstats` and a text report), the tracemalloc peak
+    and top allocations, and wall clock samples in folded format.
+    """
+    run = f"{name}/{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}"
+    logger.info(f"Profiling run {run}")
+
+    profiler = cProfile.Profile()
+    sampler = WallClockSampler(threading.get_ident())
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    sampler.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        try:
+            # Same format as Profile.dump_stats, readable with pstats.Stats
+            profiler.create_stats()
+            write(f"{run}/cprofile.pstats", marshal.dumps(profiler.stats))
+            write(f"{run}/cprofile.txt", _cprofile_report(profiler).encode('utf-8'))
+            write(f"{run}/tracemalloc.txt", _tracemalloc_report(snapshot, peak).encode('utf-8'))
+            write(f"{run}/wallclock.folded", sampler.folded().encode('utf-8'))
+            logger.info(f"Profiled run {run} in {elapsed:.1f}s, peak traced memory {peak / 1024 / 1024:.1f} MiB")
+        except Exception:
+            # A failure to save the profile shouldn't fail the run
+            logger.exception(f"Could not write profile artifacts for run {run}")
@@ -0,0 +1,81 @@
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Keys dropped at any depth unless they are asked for, HAL links aren't used downstream
+DEFAULT_EXCLUDE = ('_links',)
+
+
+def parse_fields(value: Optional[str]) -> Optional[List[str]]:
+    """Parses a comma separated list of dotted field paths, None keeps every field"""
+    if not value or value.strip() == '*':
+        return None
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+
+def _field_tree(fields: Iterable[str]) -> dict:
+    tree = {}
+    for field in fields:
+        node = tree
+        parts = field.split('.')
+        for part in parts[:-1]:
+            # A parent that is already kept in full stays in full
+            if node.get(part, {}) is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def _project(value, tree: dict):
+    if isinstance(value, list):
+        return [_project(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    projected = {}
+    for key, subtree in tree.items():
+        if key in value:
+            projected[key] = value[key] if subtree is None else _project(value[key], subtree)
+    return projected
+
+
+class Projection:
+    """Prunes the records of a stream to the fields used downstream
+
+    `fields` are dotted paths such as `dimensions.weight`, the primary key is
+    always kept. Without fields every field is kept except the excluded
+    keys, which are dropped while the response is decoded. Records are held
+    as `(keys, values)` tuples until they are serialized, with one shared
+    keys tuple per layout.
+    """
+
+    def __init__(self, fields: Optional[List[str]] = None, primary_key: Iterable[str] = (),
+                 exclude: Iterable[str] = DEFAULT_EXCLUDE):
+        self._tree = _field_tree(list(primary_key) + fields) if fields is not None else None
+        self._exclude = frozenset(exclude) - {field.split('.')[0] for field in fields or ()}
+        self._layouts: Dict[tuple, tuple] = {}
+
+    def object_pairs_hook(self, pairs: List[Tuple[str, object]]) -> dict:
+        """`json.loads` hook that drops the excluded keys as objects are decoded"""
+        return {key: value for key, value in pairs if key not in self._exclude}
+
+    def loads(self, data):
+        return json.loads(data, object_pairs_hook=self.object_pairs_hook)
+
+    def project(self, record: dict) -> dict:
+        if self._tree is None:
+            return record
+        return _project(record, self._tree)
+
+    def compact(self, record: dict) -> tuple:
+        record = self.project(record)
+        keys = tuple(record)
+        return self._layouts.setdefault(keys, keys), tuple(record.values())
+
+    def compact_all(self, records: Iterable[dict]) -> List[tuple]:
+        return [self.compact(record) for record in records]
+
+    @staticmethod
+    def expand(compact: tuple) -> dict:
+        keys, values = compact
+        return dict(zip(keys, values))
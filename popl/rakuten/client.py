@@ -1,19 +1,37 @@
 import json
 
 from popl.rakuten.errors import raise_for_error
-from requests import Session
+from popl.transport import HttpTransport
 
 
 class RakutenClient:
+    """Async client, open it with `async with` to authenticate and start a session"""
     base_url = 'https://api.rakutensl.com'
 
-    def __init__(self, client_id: int, api_user: str, api_secret:str):
+    def __init__(self, client_id: int, api_user: str, api_secret:str, max_connections: int = 4,
+                 rate_limit: float = None):
         self._client_id = client_id
         self._api_user = api_user
         self._api_secret = api_secret
-        self._session = Session()
+        self._max_connections = max_connections
+        self._rate_limit = rate_limit
+        self._transport = None
         self._access_token = None
 
+    async def __aenter__(self):
+        self._transport = HttpTransport(self.base_url, 'rakuten', max_connections=self._max_connections,
+                                        rate_limit=self._rate_limit)
+        await self._transport.__aenter__()
+        try:
+            await self._get_access_token()
+        except BaseException:
+            await self._transport.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._transport.__aexit__(*exc_info)
+
     def _build_auth_body(self):
         return json.dumps({
             "clientId": self._client_id,
@@ -21,37 +39,39 @@ class RakutenClient:
             "apiUserSecret": self._api_secret,
         })
 
-    def _get_access_token(self):
-        url = self._build_url('/Auth')
+    async def _get_access_token(self):
         data = self._build_auth_body()
         headers = {'Content-Type': 'application/json'}
 
-        response = self._post(url, headers=headers, data=data)
+        response = await self._post('/Auth', headers=headers, data=data)
 
         self._access_token = response['data']['token']
 
-    def _build_url(self, endpoint):
-        return f"{self.base_url}{endpoint}"
-
-    def _get(self, url, headers=None, params=None, data=None):
-        return self._make_request(url, method='GET', headers=headers, params=params, data=data)
+    async def _get(self, endpoint, headers=None, params=None, data=None, object_pairs_hook=None):
+        return await self._make_request(endpoint, method='GET', headers=headers, params=params, data=data,
+                                        object_pairs_hook=object_pairs_hook)
 
-    def _post(self, url, headers=None, params=None, data=None):
-        return self._make_request(url, method='POST', headers=headers, params=params, data=data)
+    async def _post(self, endpoint, headers=None, params=None, data=None):
+        return await self._make_request(endpoint, method='POST', headers=headers, params=params, data=data)
 
-    def _make_request(self, url, method, headers=None, params=None, data=None):
-
-        if not headers:
+    async def _make_request(self, endpoint, method, headers=None, params=None, data=None, object_pairs_hook=None):
+        authenticated = not headers
+        if authenticated:
             headers = self._get_headers()
 
-        with self._session as session:
-            response = session.request(method, url, headers=headers, params=params, data=data)
+        response = await self._transport.request(method, endpoint, headers=headers, params=params, data=data)
+
+        # The token is shared by every page of a run, get a new one once it expires
+        if response.status_code == 401 and authenticated:
+            await self._get_access_token()
+            response = await self._transport.request(method, endpoint, headers=self._get_headers(), params=params,
+                                                     data=data)
 
-            if response.status_code != 200:
-                raise_for_error(response)
-                return None
+        if response.status_code != 200:
+            raise_for_error(response)
+            return None
 
-            return response.json()
+        return response.json(object_pairs_hook=object_pairs_hook)
 
     def _get_headers(self):
         return {
@@ -60,7 +80,5 @@ class RakutenClient:
             'Content-Type': 'application/json',
         }
 
-    def get_items(self, params=None, *args, **kwargs):
-        self._get_access_token()
-        url = self._build_url('/Items')
-        return self._get(url, params=params)
+    async def get_items(self, params=None, object_pairs_hook=None, *args, **kwargs):
+        return await self._get('/Items', params=params, object_pairs_hook=object_pairs_hook)
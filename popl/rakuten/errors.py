@@ -1,5 +1,3 @@
-import requests
-
 class RakutenClientError(Exception):
     def __init__(self, message=None, response=None):
         super().__init__(message)
@@ -100,16 +98,12 @@ ERROR_CODE_EXCEPTION_MAPPING = {
 
 
 def raise_for_error(resp):
-    try:
-        resp.raise_for_status()
-    except (requests.HTTPError, requests.ConnectionError) as error:
-        try:
-            error_code = resp.status_code
-            client_exception = ERROR_CODE_EXCEPTION_MAPPING.get(error_code, {})
-            exc = client_exception.get('raise_exception', RakutenClientError)
-            message = client_exception.get('message', 'Client Error')
-
-            raise exc(message, resp) from None
-
-        except (ValueError, TypeError):
-            raise RakutenClientError(error) from None
\ No newline at end of file
+    if resp.status_code < 400:
+        return
+
+    error_code = resp.status_code
+    client_exception = ERROR_CODE_EXCEPTION_MAPPING.get(error_code, {})
+    exc = client_exception.get('raise_exception', RakutenClientError)
+    message = client_exception.get('message', 'Client Error')
+
+    raise exc(message, resp)
@@ -1,60 +1,93 @@
 import datetime
-import json
 import os
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List
 
 from dateutil import parser
+from popl import metrics
+from popl.encoder import encode_response, streamed_response
+from popl.paginator import PageNumberPaginator
+from popl.projection import Projection, parse_fields
 from popl.rakuten.client import RakutenClient
+from popl.snapshot import SnapshotDiff, snapshot_store
 
 CLIENT_ID = os.getenv('RAKUTEN_CLIENT_ID')
 USER_ID = os.getenv('RAKUTEN_API_USER_ID')
 USER_SECRET = os.getenv('RAKUTEN_API_SECRET')
 PAGE_SIZE = 1000
+# Pages fetched at a time, and the maximum requests per second when set
+RAKUTEN_CONCURRENCY = int(os.getenv('RAKUTEN_CONCURRENCY', 4))
+RAKUTEN_RATE_LIMIT = float(os.getenv('RAKUTEN_RATE_LIMIT', 0)) or None
+# Comma separated fields to keep, such as `name,dimensions.weight`. Every field but HAL links by default
+RAKUTEN_ITEMS_FIELDS = parse_fields(os.getenv('RAKUTEN_ITEMS_FIELDS'))
+ITEMS_PRIMARY_KEY = ["stockKeepingUnit"]
 
 
 def rakuten_handler(request):
-    now = datetime.datetime.utcnow()
+    """Streams the response, the records are fetched while it is being written"""
+    request_json = request.get_json() or {}
+    return streamed_response(_rakuten_response(request_json))
 
-    state = {
-        'bookmarks': {
-            'items': now.isoformat(),
+
+def _rakuten_response(request_json: dict) -> Iterator[str]:
+    with metrics.run('rakuten'):
+        snapshots = request_json.get('state', {}).get('snapshots') or {}
+        now = datetime.datetime.utcnow()
+
+        # Items are a full refresh, only the changed ones are sent
+        items = SnapshotDiff(snapshot_store(), 'rakuten/items', ITEMS_PRIMARY_KEY, snapshots.get('items'))
+        insert = {
+            "items": items.filter(get_items_data(on_total=items.expect)),
         }
-    }
 
-    insert = {
-        "items": get_items_data(),
-    }
+        def delete() -> dict:
+            return {
+                "items": items.deletes(),
+            }
 
-    return assemble_response_json(insert, state), 200, {"Content-Type": "application/json"}
+        def state() -> dict:
+            items.commit()
+            return {
+                'bookmarks': {
+                    'items': now.isoformat(),
+                },
+                'snapshots': {
+                    'items': items.version,
+                },
+            }
+
+        yield from assemble_response_json(insert, state, delete)
 
 
-def get_items_data():
-    client = RakutenClient(CLIENT_ID, USER_ID, USER_SECRET)
+def get_items_data(on_total: Callable[[int], None] = None) -> Iterator[dict]:
+    """Streams the items, fetching up to RAKUTEN_CONCURRENCY pages at a time
+
+    The total number of items the API reports is passed to `on_total` when set.
+    """
+    client = RakutenClient(CLIENT_ID, USER_ID, USER_SECRET, max_connections=RAKUTEN_CONCURRENCY,
+                           rate_limit=RAKUTEN_RATE_LIMIT)
 
     print('getting items from rakuten...')
-    page = 1
-    page_size = PAGE_SIZE
-    params = {'pageSize': page_size, 'page': page}
-    paginate = True
-    running_total = 0
-    results = []
-
-    while paginate:
-        response = client.get_items(params=params)
-        total_results = response['pageMetadata']['totalResults']
-        running_total += page_size
-        print(f"total results: {total_results}")
-        print(f"running total: {running_total}")
 
-        paginate = running_total < total_results
-        page += 1
-        params.update({'page': page})
-        print(f"fetching data for page: {page}")
+    # Records are pruned as pages are decoded and kept compact until they are diffed and written
+    projection = Projection(RAKUTEN_ITEMS_FIELDS, ITEMS_PRIMARY_KEY)
 
-        results.extend(response['data'])
+    async def fetch_page(page: int) -> dict:
+        print(f"fetching data for page: {page}")
+        response = await client.get_items(params={'pageSize': PAGE_SIZE, 'page': page},
+                                          object_pairs_hook=projection.object_pairs_hook)
+        response['data'] = projection.compact_all(response['data'])
+        return response
 
+    def get_total(response: dict) -> int:
+        total_results = response['pageMetadata']['totalResults']
+        print(f"total results: {total_results}")
+        if on_total:
+            on_total(total_results)
+        return total_results
 
-    return results
+    records = PageNumberPaginator(fetch_page, lambda response: response['data'], PAGE_SIZE, get_total=get_total,
+                                  concurrency=RAKUTEN_CONCURRENCY, context=client).records()
+    return map(projection.expand, records)
 
 
 def get_bookmark(bookmarks: List, key: str) -> datetime.datetime:
@@ -69,22 +102,20 @@ def get_bookmark(bookmarks: List, key: str) -> datetime.datetime:
     return parser.parse(bookmark)
 
 
-def assemble_response_json(insert, state):
-    response_dict = {
-        "state": state,
-        "schema": {
-            "items": {
-                "primary_key": [
-                    "stockKeepingUnit"
-                ]
-            }
-        },
-        "insert": insert,
-        "hasMore": False
+def assemble_response_json(insert: Dict[str, Iterable[dict]], state: Callable[[], dict],
+                           delete: Callable[[], dict] = None) -> Iterator[str]:
+    schema = {
+        "items": {
+            "primary_key": ITEMS_PRIMARY_KEY
+        }
     }
-    return json.dumps(response_dict)
+    return encode_response(schema, insert, state, delete)
 
 
 if __name__ == '__main__':
-    response = rakuten_handler({})
-    print(response)
\ No newline at end of file
+    class Request:
+        def get_json(self):
+            return {}
+
+    response = rakuten_handler(Request())
+    print(''.join(response.response))
\ No newline at end of file
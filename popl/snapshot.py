@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# Set to false to always send every record
+SNAPSHOT_DIFF = os.getenv('SNAPSHOT_DIFF', 'true').lower() == 'true'
+# Indexes are kept in SNAPSHOT_BUCKET when set, otherwise in SNAPSHOT_DIR
+SNAPSHOT_BUCKET = os.getenv('SNAPSHOT_BUCKET')
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '/tmp/snapshots')
+SNAPSHOT_PREFIX = '_snapshots'
+
+
+class LocalSnapshotStore:
+    def __init__(self, path: str):
+        self._path = path
+
+    def read(self, name: str) -> Optional[bytes]:
+        filename = os.path.join(self._path, name)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def write(self, name: str, data: bytes):
+        filename = os.path.join(self._path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def list(self, prefix: str) -> List[str]:
+        directory = os.path.join(self._path, prefix)
+        if not os.path.isdir(directory):
+            return []
+        return [f"{prefix}/{name}" for name in os.listdir(directory)]
+
+    def delete(self, name: str):
+        os.remove(os.path.join(self._path, name))
+
+
+class GCSSnapshotStore:
+    def __init__(self, bucket_name: str, prefix: str = SNAPSHOT_PREFIX):
+        from google.cloud import storage
+        self._client = storage.Client()
+        self._bucket = self._client.bucket(bucket_name)
+        self._prefix = prefix
+
+    def read(self, name: str) -> Optional[bytes]:
+        blob = self._bucket.blob(f"{self._prefix}/{name}")
+        if not blob.exists():
+            return None
+        return blob.download_as_bytes()
+
+    def write(self, name: str, data: bytes):
+        self._bucket.blob(f"{self._prefix}/{name}").upload_from_string(data)
+
+    def list(self, prefix: str) -> List[str]:
+        blobs = self._client.list_blobs(self._bucket, prefix=f"{self._prefix}/{prefix}/")
+        return [blob.name[len(self._prefix) + 1:] for blob in blobs]
+
+    def delete(self, name: str):
+        self._bucket.blob(f"{self._prefix}/{name}").delete()
+
+
+def snapshot_store():
+    if SNAPSHOT_BUCKET:
+        return GCSSnapshotStore(SNAPSHOT_BUCKET)
+    return LocalSnapshotStore(SNAPSHOT_DIR)
+
+
+def _content_hash(record: dict) -> str:
+    data = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SnapshotDiff:
+    """Emits only the records of a full refresh stream that changed since the last run
+
+    An index of content hashes keyed by primary key is saved for every run
+    under a new version, which is returned to Fivetran in the state. The next
+    run diffs against the version from the state it receives, so a response
+    that Fivetran didn't accept is simply diffed against again. When there is
+    no index for the version every record is sent.
+    """
+
+    def __init__(self, store, name: str, primary_key: List[str], previous_version: Optional[str]):
+        self._store = store
+        self._name = name
+        self._primary_key = primary_key
+        self.previous_version = previous_version
+        self.version = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._previous = self._load(previous_version) if SNAPSHOT_DIFF else {}
+        self._current: Dict[str, str] = {}
+        self.changed = 0
+        self.unchanged = 0
+        self.expected_total: Optional[int] = None
+        self.complete = False
+
+    def _filename(self, version: str) -> str:
+        return f"{self._name}/{version}.json.gz"
+
+    def _load(self, version: Optional[str]) -> Dict[str, str]:
+        if not version:
+            return {}
+        data = self._store.read(self._filename(version))
+        if data is None:
+            print(f"No snapshot {version} found for {self._name}, sending every record")
+            return {}
+        return json.loads(gzip.decompress(data))
+
+    def _key(self, record: dict) -> str:
+        return json.dumps([record.get(field) for field in self._primary_key], separators=(',', ':'), default=str)
+
+    def expect(self, total: int):
+        """Sets the number of records the API reported for the stream"""
+        self.expected_total = total
+
+    def filter(self, records: Iterable[dict]) -> Iterator[dict]:
+        """Yields the new and changed records while indexing every record"""
+        self.complete = False
+        for record in records:
+            key = self._key(record)
+            content_hash = _content_hash(record)
+            self._current[key] = content_hash
+            if self._previous.get(key) == content_hash:
+                self.unchanged += 1
+                continue
+            self.changed += 1
+            yield record
+        self.complete = True
+
+    def _seen_everything(self) -> bool:
+        seen = self.changed + self.unchanged
+        return self.complete and (self.expected_total is None or seen == self.expected_total)
+
+    def deletes(self) -> List[dict]:
+        """Primary keys of records that disappeared, call once the records are filtered
+
+        Nothing is deleted unless the records were read to the end and add up
+        to the total the API reported, so a partial read doesn't delete the
+        rows it missed. Those keys are kept in the index for the next run.
+        """
+        deleted = self._previous.keys() - self._current.keys()
+        if not self._seen_everything():
+            print(f"{self._name}: saw {self.changed + self.unchanged} of {self.expected_total} records, "
+                  f"not deleting {len(deleted)} missing records")
+            for key in deleted:
+                self._current[key] = self._previous[key]
+            return []
+        return [dict(zip(self._primary_key, json.loads(key))) for key in sorted(deleted)]
+
+    def commit(self):
+        """Saves the index of this run and drops versions that are no longer needed"""
+        if not SNAPSHOT_DIFF:
+            return
+        self._store.write(self._filename(self.version), gzip.compress(json.dumps(self._current).encode('utf-8')))
+        keep = {self._filename(self.version)}
+        if self.previous_version:
+            keep.add(self._filename(self.previous_version))
+        for name in self._store.list(self._name):
+            if name not in keep:
+                self._store.delete(name)
+        print(f"{self._name}: {self.changed} changed records, {self.unchanged} unchanged, "
+              f"{len(self._previous.keys() - self._current.keys())} deleted")
@@ -1,35 +1,37 @@
-import requests
 import json
 import base64
 
 from popl.tpl.errors import TPLAPIError
+from popl.transport import HttpTransport
 
 
 class TPLClient(object):
-    """Generic API for TPL"""
+    """Generic async API for TPL, open it with `async with` to authenticate and start a session"""
     _base_url = 'https://secure-wms.com'
     _auth_path = 'AuthServer/api/Token'
 
     def __init__(self, client_id=None, client_secret=None, tpl_key=None,
-                 grant_type='client_credentials', user_login_id=None, session=None, verify_ssl=True):
+                 grant_type='client_credentials', user_login_id=None, transport=None, verify_ssl=True,
+                 max_connections=4, rate_limit=None):
         """
-        Create an instance, get access token and update the headers
+        Create an instance, the access token is fetched when it is opened
         :param client_id: client id of TPL.
         :param client_secret: client secret key of TPL.
         :param tpl_key: WH specific TPL key.
         :param grant_type: by default 'client_credentials'.
         :param user_login_id: TPL user id.
-        :param session: pass a custom requests Session.
+        :param transport: pass a custom HttpTransport, its headers must already authorize requests.
         :param verify_ssl: skip SSL validation.
-        
+        :param max_connections: connections kept open to the server.
+        :param rate_limit: maximum requests per second.
+
         :Example:
             from tpl import TPLClient
-            api = TPLClient(base_url, auth_path, client_id, client_secret, tpl_key,
-                            grant_type, user_login_id, session, verify_ssl)
-            api.get("orders", "13654")
-            
-            payload = {}
-            api.post("orders", data=payload)
+            async with TPLClient(client_id, client_secret, tpl_key, grant_type, user_login_id) as api:
+                await api.get("orders", "13654")
+
+                payload = {}
+                await api.post("orders", data=payload)
         """
         self._client_id = client_id
         self._client_secret = client_secret
@@ -37,19 +39,35 @@ class TPLClient(object):
         self._grant_type = grant_type
         self._user_login_id = user_login_id
         self._verify_ssl = verify_ssl
+        self._max_connections = max_connections
+        self._rate_limit = rate_limit
+        self._owns_transport = transport is None
+        self.client = transport
+        self.headers = {}
 
-        if session is None:
-            self.client = requests.Session()
-            response = self._get_access_token()
-            headers = {
-                "Authorization": f"{response['token_type']} {response['access_token']}",
-                "Content-Type": "application/hal+json"
-            }
-            self.client.headers.update(headers)
-        else:
-            self.client = session
+    async def __aenter__(self):
+        if not self._owns_transport:
+            return self
+
+        self.client = HttpTransport(self._base_url, 'tpl', max_connections=self._max_connections,
+                                    rate_limit=self._rate_limit, verify_ssl=self._verify_ssl)
+        await self.client.__aenter__()
+        try:
+            response = await self._get_access_token()
+        except BaseException:
+            await self.client.__aexit__(None, None, None)
+            raise
+        self.headers = {
+            "Authorization": f"{response['token_type']} {response['access_token']}",
+            "Content-Type": "application/hal+json"
+        }
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._owns_transport:
+            await self.client.__aexit__(*exc_info)
 
-    def _get_access_token(self):
+    async def _get_access_token(self):
         """Get access token from server and returns it.
         :return: access token from the server.
         """
@@ -63,7 +81,7 @@ class TPLClient(object):
             "grant_type": self._grant_type,
             "user_login_id": self._user_login_id
         }
-        return self.post(self._auth_path, data=data, add_headers=headers)
+        return await self.post(self._auth_path, data=data, add_headers=headers)
 
     def _parse_error(self, content):
         """Take the content and return as it is.
@@ -74,7 +92,7 @@ class TPLClient(object):
 
     def _check_status_code(self, status_code, content):
         """Take the status code and check it.
-        Throw an exception if the server didn't return 200 or 201 or 202 code.
+        Throw an exception if the server didn't return a 2xx code.
         :param status_code: status code returned by the server.
         :param content: content returned by the server.
         :return: True or raise an exception TPLAPIError.
@@ -89,7 +107,7 @@ class TPLClient(object):
             500: 'Internal Server Error',
         }
 
-        if status_code in (200, 201, 202):
+        if 200 <= status_code < 300:
             return True
         elif status_code in message_by_code:
             tpl_error_msg = self._parse_error(content)
@@ -100,45 +118,48 @@ class TPLClient(object):
             raise TPLAPIError('Unknown error', status_code,
                            tpl_error_msg=tpl_error_msg)
 
-    def _execute(self, url, method, params=None, data=None, add_headers=None):
+    async def _execute(self, path, method, params=None, data=None, add_headers=None, object_pairs_hook=None):
         """Perform the HTTP request and return the response back.
-        :param url: full url to call.
+        :param path: path to call, relative to the base url.
         :param method: GET, POST.
         :param data: POST (add) only.
         :param add_headers: additional headers merged into instance's headers.
+        :param object_pairs_hook: optional hook passed to json.loads when decoding the response.
         :return: response in json format.
         """
         if add_headers is None:
             add_headers = {}
 
-        request_headers = self.client.headers.copy()
+        request_headers = self.headers.copy()
         request_headers.update(add_headers)
 
-        response = self.client.request(
+        response = await self.client.request(
             method,
-            url,
+            path,
             params=params,
             data=data,
-            verify=self._verify_ssl,
             headers=request_headers
         )
-        # self._check_status_code(response.status_code, response.content)
-        return response.json()
+        # An error body would otherwise be read as an empty page
+        self._check_status_code(response.status_code, response.text)
+        return response.json(object_pairs_hook=object_pairs_hook)
 
-    def get(self, resource_path, resource_id=None, params=None, add_headers=None):
+    async def get(self, resource_path, resource_id=None, params=None, add_headers=None, object_pairs_hook=None):
         """Retrieve (GET) a resource.
         :param resource_path: path of resource to retrieve.
         :param resource_id: optional resource id to retrieve.
         :param querystring: optional RQL querystring.
         :param add_headers: additional headers merged into instance's headers.
+        :param object_pairs_hook: optional hook passed to json.loads when decoding the response.
         :return: response in json format.
         """
-        full_url = f"{self._base_url}/{resource_path}"
+        path = f"/{resource_path}"
         if resource_id is not None:
-            full_url += f"/{resource_id}"
-        return self._execute(full_url, 'GET', params=params, add_headers=add_headers)
+            path += f"/{resource_id}"
+        return await self._execute(path, 'GET', params=params, add_headers=add_headers,
+                                   object_pairs_hook=object_pairs_hook)
 
-    def post(self, resource_path, data=None, add_headers=None):
+    async def post(self, resource_path, data=None, add_headers=None):
         """Add (POST) a resource.
         :param resource_path: path of resource to create.
         :param data: full payload as dict of new resource.
@@ -147,5 +168,4 @@ class TPLClient(object):
         """
         if data is None:
             raise ValueError('Data Undefined.')
-        full_url = f"{self._base_url}/{resource_path}"
-        return self._execute(full_url, 'POST', data=json.dumps(data), add_headers=add_headers)
+        return await self._execute(f"/{resource_path}", 'POST', data=json.dumps(data), add_headers=add_headers)
@@ -1,54 +1,94 @@
 import datetime
-import json
 import os
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List
 
 from dateutil import parser
+from popl import metrics
+from popl.encoder import encode_response, streamed_response
+from popl.paginator import PageNumberPaginator
+from popl.projection import Projection, parse_fields
+from popl.snapshot import SnapshotDiff, snapshot_store
 from popl.tpl.client import TPLClient
 
 USER_ID = os.getenv('TPL_USER_ID')
 CLIENT_ID = os.getenv('TPL_CLIENT_ID')
 CLIENT_SECRET = os.getenv('TPL_CLIENT_SECRET')
 PAGE_SIZE = 1000
+# Pages fetched at a time, and the maximum requests per second when set
+TPL_CONCURRENCY = int(os.getenv('TPL_CONCURRENCY', 4))
+TPL_RATE_LIMIT = float(os.getenv('TPL_RATE_LIMIT', 0)) or None
+# Comma separated fields to keep, such as `name,dimensions.weight`. Every field but HAL links by default
+TPL_INVENTORY_FIELDS = parse_fields(os.getenv('TPL_INVENTORY_FIELDS'))
+INVENTORY_PRIMARY_KEY = ["ReceiveItemId"]
 
 
 def tpl_handler(request):
-    now = datetime.datetime.utcnow()
+    """Streams the response, the records are fetched while it is being written"""
+    request_json = request.get_json() or {}
+    return streamed_response(_tpl_response(request_json))
 
-    state = {
-        'bookmarks': {
-            'inventory': now.isoformat(),
+
+def _tpl_response(request_json: dict) -> Iterator[str]:
+    with metrics.run('tpl'):
+        snapshots = request_json.get('state', {}).get('snapshots') or {}
+        now = datetime.datetime.utcnow()
+
+        # Inventory is a full refresh, only the changed rows are sent
+        inventory = SnapshotDiff(snapshot_store(), 'tpl/inventory', INVENTORY_PRIMARY_KEY, snapshots.get('inventory'))
+        insert = {
+            "inventory": inventory.filter(get_inventory(on_total=inventory.expect)),
         }
-    }
 
-    insert = {
-        "inventory": get_inventory(),
-    }
+        def delete() -> dict:
+            return {
+                "inventory": inventory.deletes(),
+            }
+
+        def state() -> dict:
+            inventory.commit()
+            return {
+                'bookmarks': {
+                    'inventory': now.isoformat(),
+                },
+                'snapshots': {
+                    'inventory': inventory.version,
+                },
+            }
+
+        yield from assemble_response_json(insert, state, delete)
 
-    return assemble_response_json(insert, state), 200, {"Content-Type": "application/json"}
 
+def get_inventory(on_total: Callable[[int], None] = None) -> Iterator[dict]:
+    """Streams the inventory, fetching up to TPL_CONCURRENCY pages at a time
 
-def get_inventory():
-    client = TPLClient(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, user_login_id=USER_ID)
+    `TotalResults` is the number of records across all pages, so it gives
+    the number of pages to fetch. It is passed to `on_total` when set.
+    """
+    client = TPLClient(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, user_login_id=USER_ID,
+                       max_connections=TPL_CONCURRENCY, rate_limit=TPL_RATE_LIMIT)
 
     print('getting items from 3pl...')
-    page = 1
-    params = {'pgsiz': PAGE_SIZE, 'sort': 'receivedDate', 'pgnum': page}
-    total_results = PAGE_SIZE
-    results = []
 
-    while total_results == PAGE_SIZE:
+    # Records are pruned as pages are decoded and kept compact until they are diffed and written
+    projection = Projection(TPL_INVENTORY_FIELDS, INVENTORY_PRIMARY_KEY)
+
+    async def fetch_page(page: int) -> dict:
         print(f"fetching data for page: {page}")
-        response = client.get("inventory", params=params)
+        response = await client.get("inventory", params={'pgsiz': PAGE_SIZE, 'sort': 'receivedDate', 'pgnum': page},
+                                    object_pairs_hook=projection.object_pairs_hook)
+        response['ResourceList'] = projection.compact_all(response.get('ResourceList', []))
+        return response
+
+    def get_total(response: dict) -> int:
         total_results = response.get('TotalResults', 0)
         print(f"total results: {total_results}")
+        if on_total:
+            on_total(total_results)
+        return total_results
 
-        page += 1
-        params.update({'pgnum': page})
-
-        results.extend(response.get('ResourceList', []))
-
-    return results
+    records = PageNumberPaginator(fetch_page, lambda response: response.get('ResourceList', []), PAGE_SIZE,
+                                  get_total=get_total, concurrency=TPL_CONCURRENCY, context=client).records()
+    return map(projection.expand, records)
 
 
 def get_bookmark(bookmarks: List, key: str) -> datetime.datetime:
@@ -63,22 +103,20 @@ def get_bookmark(bookmarks: List, key: str) -> datetime.datetime:
     return parser.parse(bookmark)
 
 
-def assemble_response_json(insert, state):
-    response_dict = {
-        "state": state,
-        "schema": {
-            "inventory": {
-                "primary_key": [
-                    "ReceiveItemId"
-                ]
-            }
-        },
-        "insert": insert,
-        "hasMore": False
+def assemble_response_json(insert: Dict[str, Iterable[dict]], state: Callable[[], dict],
+                           delete: Callable[[], dict] = None) -> Iterator[str]:
+    schema = {
+        "inventory": {
+            "primary_key": INVENTORY_PRIMARY_KEY
+        }
     }
-    return json.dumps(response_dict)
+    return encode_response(schema, insert, state, delete)
 
 
 if __name__ == '__main__':
-    response = tpl_handler({})
-    print(response)
\ No newline at end of file
+    class Request:
+        def get_json(self):
+            return {}
+
+    response = tpl_handler(Request())
+    print(''.join(response.response))
\ No newline at end of file
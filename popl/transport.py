@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Optional
+
+import aiohttp
+
+from popl import metrics
+
+# Requests are retried this many times on connection errors and retryable statuses
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+# Seconds a single request may take, including reading the body
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 60))
+# Seconds idle connections are kept open for reuse
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """Spaces requests out to at most `rate` per second, no limit when `rate` is not set"""
+
+    def __init__(self, rate: Optional[float] = None):
+        self._interval = 1 / rate if rate else 0
+        self._next = 0.0
+
+    async def acquire(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Response:
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+
+def _retry_delay(attempt: int, response: Optional[Response] = None) -> float:
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return 2 ** attempt + random.random()
+
+
+class HttpTransport:
+    """Pooled keep-alive HTTP client with rate limiting and per request retries
+
+    The session is bound to the event loop it is opened in, so open it with
+    `async with` inside the loop making the requests. Every request is timed
+    as `{name}.{method} {path}` in the current run's metrics.
+    """
+
+    def __init__(self, base_url: str, name: str, headers: Optional[dict] = None, max_connections: int = 4,
+                 rate_limit: Optional[float] = None, max_retries: int = HTTP_MAX_RETRIES,
+                 timeout: float = HTTP_TIMEOUT, verify_ssl: bool = True):
+        self.base_url = base_url
+        self.name = name
+        self.headers = headers or {}
+        self._max_connections = max_connections
+        self._limiter = RateLimiter(rate_limit)
+        self._max_retries = max_retries
+        self._timeout = timeout
+        self._verify_ssl = verify_ssl
+        self._session = None
+
+    async def __aenter__(self) -> 'HttpTransport':
+        connector = aiohttp.TCPConnector(limit=self._max_connections, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                                         ssl=None if self._verify_ssl else False)
+        self._session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                              timeout=aiohttp.ClientTimeout(total=self._timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def request(self, method: str, path: str, params: Optional[dict] = None, data=None,
+                      headers: Optional[dict] = None) -> Response:
+        if params:
+            params = {key: str(value) for key, value in params.items() if value is not None}
+        run_metrics = metrics.current()
+        url = f"{self.base_url}{path}"
+
+        for attempt in range(self._max_retries + 1):
+            await self._limiter.acquire()
+            response = None
+            try:
+                with run_metrics.timer(f'{self.name}.{method} {path}'):
+                    async with self._session.request(method, url, params=params, data=data, headers=headers) as resp:
+                        response = Response(resp.status, resp.headers, await resp.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                if attempt == self._max_retries:
+                    raise
+                reason = repr(error)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self._max_retries:
+                    return response
+                reason = f"status {response.status_code}"
+
+            delay = _retry_delay(attempt, response)
+            run_metrics.incr(f'{self.name}.retries')
+            print(f"{method} {path} failed with {reason}. Sleeping {delay:.1f} seconds before trying again")
+            await asyncio.sleep(delay)
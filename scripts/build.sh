@@ -7,8 +7,10 @@ DEFAULT_BATCH_SIZE=$4
 MAX_RUN_TIME=$5
 
 # usage: ./build.sh PROJECT_ID BASE_IMAGE_NAME BUCKET DEFAULT_BATCH_SIZE MAX_RUN_TIME
+# Run from the repo root, the build context is the root so the image can copy the shared popl modules
 docker buildx build --platform linux/amd64 \
     --build-arg BUCKET=${BUCKET} \
     --build-arg DEFAULT_BATCH_SIZE=${DEFAULT_BATCH_SIZE} \
     --build-arg MAX_RUN_TIME=${MAX_RUN_TIME} \
-    -t gcr.io/${PROJECT_ID}/${BASE_IMAGE_NAME}:latest ./firebase
\ No newline at end of file
+    -f firebase/Dockerfile \
+    -t gcr.io/${PROJECT_ID}/${BASE_IMAGE_NAME}:latest .
\ No newline at end of file